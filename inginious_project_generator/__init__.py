@@ -4,20 +4,35 @@
 # more information about the licensing of this file.
 
 import os
+import time
+import logging
 
-from flask import request, redirect
+from flask import request, jsonify, abort, send_file
+from inginious.common.exceptions import CourseNotFoundException, TaskNotFoundException
+from inginious.frontend.pages.course import handle_course_unavailable
 from inginious.frontend.pages.course_admin.utils import INGIniousAdminPage
 from inginious.frontend.pages.tasks import TaskPage
-from inginious_project_generator.generator import run, run_all
+from inginious_project_generator.generator import run_all, run_with_report, verify_all, CourseWatcher
+from inginious_project_generator.jobs import JobQueue
 
 __version__ = "0.1.dev0"
+logger = logging.getLogger("inginious.webapp.plugin.project_generator")
 PATH_TO_PLUGIN = os.path.abspath(os.path.dirname(__file__))
 DEFAULT_CONFIG = {
     "resources_path": "public",
     "tests_path": "unit_test",
     "libraries_path": "$common/libs",
-    "archive_path": "public"
+    "archive_path": "public",
+    "workers": 1,
+    "sources_compression": generator.DEFAULT_COMPRESSION["sources"],
+    "libs_compression": generator.DEFAULT_COMPRESSION["libs"],
+    **generator.DEFAULT_SELECTION
 }
+ARCHIVE_MAX_AGE = 60  # seconds during which the browser of the user can use an archive without revalidating it
+job_queue = JobQueue()
+watch_settings = None  # the watch settings of the plugin configuration, None if the courses are not watched
+_watchers = {}  # course id -> watcher of the course
+_configurations = {}  # course id -> ('intellij' entry of the descriptor of the course, configuration of the course)
 
 
 class ProjectGeneratorPage(INGIniousAdminPage):
@@ -26,6 +41,14 @@ class ProjectGeneratorPage(INGIniousAdminPage):
     def GET_AUTH(self, course_id):
         course, _ = self.get_course_and_check_rights(course_id, allow_all_staff=True)
         data = get_configuration_file(course)
+        job = get_job(course, request.args.get("job", ""))
+        if job is not None:
+            # display the result of a generation job, or its progress if it is not finished
+            requirements = None if job.task_id is None else get_requirements(course, job.task_id, data)
+            return self.display_page(course, job.task_id, data, job.is_finished(),
+                                     requirements is None or requirements["test_path"],
+                                     requirements is None or requirements["libs_path"], job.error is None,
+                                     requirements=requirements, report=job.reports, job=job)
         if data is not None:
             return self.display_page(course, config=data)
         else:
@@ -39,17 +62,27 @@ class ProjectGeneratorPage(INGIniousAdminPage):
         libs_path_ok = True
         generation_ok = True
         requirements = None
+        job = None
+        submitted = time.time()
         # when the button generate archive is pushed
         if input_data.get("action", "") == "generateAllProjects":
+            sources_compression, sources_error = get_compression_input(input_data, "sources_compression")
+            libs_compression, libs_error = get_compression_input(input_data, "libs_compression")
+            compression_errors = {label: error for label, error in (("Sources compression", sources_error),
+                                                                    ("Libraries compression", libs_error)) if error}
             new_data = {
                 "resources_path": input_data["resources_path"],
                 "tests_path": input_data["tests_path"],
                 "libraries_path": input_data["libraries_path"],
-                "archive_path": input_data["archive_path"]
+                "archive_path": input_data["archive_path"],
+                "workers": get_workers(input_data),
+                "sources_compression": sources_compression,
+                "libs_compression": libs_compression,
+                **get_selection_input(input_data)
             }
             # if we went directly to the generator page we generate the archive for all tasks
             if "task_to_generate" not in input_data:
-                gen_all_archive(course, new_data)
+                job = job_queue.submit(course.get_id(), None, gen_all_archive, course, new_data)
             # if we went from a test we generate only the archive for this test
             else:
                 task_id = input_data["task_to_generate"]
@@ -57,11 +90,24 @@ class ProjectGeneratorPage(INGIniousAdminPage):
                 tests_path_ok = requirements["test_path"]
                 libs_path_ok = requirements["libs_path"]
                 if generator.process_requirements(requirements):
-                    gen_task_archive(course, task_id, new_data, requirements)
+                    job = job_queue.submit(course.get_id(), task_id, gen_task_job, course, task_id, new_data,
+                                           requirements)
                 else:
                     generation_ok = False
             edit_configuration_file(self.course_factory, course, new_data)
-            return self.display_page(course, task_id, new_data, True, tests_path_ok, libs_path_ok, generation_ok, requirements)
+            return self.display_page(course, task_id, new_data, job is None, tests_path_ok, libs_path_ok, generation_ok,
+                                     requirements, job=job, job_reused=job is not None and job.submitted < submitted,
+                                     compression_errors=compression_errors)
+
+        # when the button verify archives is pushed, with the stored configuration
+        elif input_data.get("action", "") == "verifyArchives":
+            data = get_configuration_file(course)
+            job = job_queue.submit(course.get_id(), None, verify_all_archive, course, data,
+                                   deep="deep" in input_data, kind="verification")
+            finished = job.is_finished()  # a job of the course may have just finished
+            return self.display_page(course, config=data, generated=finished, generation_ok=job.error is None,
+                                     report=job.reports if finished else None, job=job,
+                                     job_reused=job.submitted < submitted)
 
         # if an admin went from a test
         elif input_data.get("action", "") == "generateProjectTask":
@@ -73,82 +119,263 @@ class ProjectGeneratorPage(INGIniousAdminPage):
             else:
                 return self.display_page(course, input_data.get("task", ""))
 
-    def display_page(self, course, task=None, config=None, generated=False, tests_path_ok=True, libs_path_ok=True, generation_ok=True, requirements=None):
+    def display_page(self, course, task=None, config=None, generated=False, tests_path_ok=True, libs_path_ok=True,
+                     generation_ok=True, requirements=None, report=None, job=None, job_reused=False,
+                     compression_errors=None):
+        """
+        Render the page of the plugin
+        :param job: The generation job whose progress or result is displayed, if any
+        :param job_reused: True if 'job' was already queued or running when the admin submitted the form, so it does
+                           not use the settings that were just submitted
+        :param compression_errors: The reason why each submitted compression setting that is not valid was replaced by
+                                   its default, by label of the setting
+        """
         if config is None:
             config = DEFAULT_CONFIG
         return self.template_helper.render("project_generator.html",
                                            template_folder=os.path.join(PATH_TO_PLUGIN, 'templates'),
                                            course=course, task_id=task, libraries_path=config["libraries_path"],
                                            resources_path=config["resources_path"], tests_path=config["tests_path"],
-                                           archive_path=config["archive_path"], generated=generated,
-                                           tests_path_ok=tests_path_ok, libs_path_ok=libs_path_ok,
-                                           generation_ok=generation_ok, requirements=requirements)
+                                           archive_path=config["archive_path"],
+                                           workers=config.get("workers", DEFAULT_CONFIG["workers"]),
+                                           compression=get_compression(config), selection=get_selection(config),
+                                           generated=generated, tests_path_ok=tests_path_ok,
+                                           libs_path_ok=libs_path_ok, generation_ok=generation_ok,
+                                           requirements=requirements, report=report, job=job, job_reused=job_reused,
+                                           compression_errors=compression_errors or {},
+                                           stages=generator.summarize_stages(report) if report else None)
 
 
-class DownloadPage(TaskPage):
-    """ Page to download the archive. Also available for students """
-    def GET(self, courseid, taskid):
-        return redirect(self.app.get_homepath() + "/course/" + courseid + "/" + taskid)
+class ProjectGeneratorStatusPage(INGIniousAdminPage):
+    """ JSON status of the generation jobs of a course """
+
+    def GET_AUTH(self, course_id):
+        course, _ = self.get_course_and_check_rights(course_id, allow_all_staff=True)
+        job = get_job(course, request.args.get("job", ""))
+        if job is not None:
+            return jsonify(job.to_dict())
+        return jsonify([job.to_dict() for job in job_queue.get_course_jobs(course.get_id())])
 
-    def POST(self, courseid, taskid):
-        course = self.course_factory.get_course(courseid)
+
+class DownloadPage(TaskPage):
+    """ Page to download the archive. Also available for students who can see the task """
+    def GET_AUTH(self, courseid, taskid):
+        # the same checks as the page of the task: the archive holds its files and tests
+        try:
+            course = self.course_factory.get_course(courseid)
+        except CourseNotFoundException:
+            abort(404)
+        if not self.user_manager.course_is_open_to_user(course):
+            return handle_course_unavailable(self.app.get_homepath(), self.template_helper, self.user_manager, course)
+        try:
+            task = course.get_task(taskid)
+        except TaskNotFoundException:
+            abort(404)
+        if not self.user_manager.task_is_visible_by_user(task):
+            return self.template_helper.render("task_unavailable.html")
         data = get_configuration_file(course)
-        archive_location = DEFAULT_CONFIG["archive_path"]
-        if data is not None and "archive_path" in data:
-            archive_location = data["archive_path"]
-        if not has_archive(course, taskid, archive_location):
-            # We generate an archive if none exists
-            requirements = get_requirements(course, taskid, data)
-            gen_task_archive(course, taskid, data, requirements)
-        return redirect(
-            self.app.get_homepath() + "/course/" + courseid + "/" + taskid + "/" + courseid + "_" + taskid + '.zip')
+        requirements = get_requirements(course, taskid, data)
+        if not generator.process_requirements(requirements):
+            abort(404)
+        # (Re)generate the archive if none exists or if its inputs changed since it was built
+        report = gen_task_archive(course, taskid, data, requirements)
+        if report["status"] == "failed":
+            logger.error("[%s/%s] Cannot generate the archive: %s", courseid, taskid, report["error"])
+            abort(500, "The archive of the task could not be generated")
+        # the archive is sent with its ETag and Last-Modified, so that unchanged archives are answered
+        # with 304 Not Modified, and interrupted downloads can be resumed with a Range request
+        response = send_file(get_archive_file(course, taskid, data), mimetype="application/zip", as_attachment=True,
+                             download_name=courseid + "_" + taskid + ".zip", conditional=True, etag=True,
+                             max_age=ARCHIVE_MAX_AGE)
+        # the archive is only sent to the users who can see the task: shared caches must not keep it
+        response.cache_control.public = False
+        response.cache_control.private = True
+        return response
+
+    def POST_AUTH(self, courseid, taskid):
+        return self.GET_AUTH(courseid, taskid)
+
+
+def get_archive_file(course, taskid, data):
+    """ Path to the archive of the specific taskid """
+    return os.path.join(course.get_fs().prefix, taskid, data["archive_path"], course.get_id() + "_" + taskid + '.zip')
+
+
+def get_course_index(course, data):
+    """
+    Get the index of the files of the course with the configuration 'data', shared by the pages and the generations
+    (see generator.get_course_index)
+    """
+    return generator.get_course_index(course.get_fs().prefix, data["libraries_path"], data["resources_path"],
+                                      data["tests_path"], data["archive_path"], get_selection(data))
 
 
 def get_requirements(course, taskid, data):
-    """ Get the requirements for the generation from generator """
-    return generator.check_requirements(course.get_fs().prefix, taskid,
-                                                        data["resources_path"], data["tests_path"],
-                                                        data["libraries_path"], data["archive_path"])
+    """
+    Get the requirements for the generation from the index of the course, refreshed for the task: the directories
+    whose modification time did not change are not listed again. The requirements must not be modified.
+    """
+    return get_course_index(course, data).get_task(taskid, max_age=0)['requirement']
 
 
 def gen_task_archive(course, taskid, data, requirements):
-    """ Generate the archive for the specific taskid """
-    run(course.get_fs().prefix, taskid, course.get_id(), data["libraries_path"],
-        data["resources_path"], data["tests_path"], data["archive_path"], requirements,
-        PATH_TO_PLUGIN)
+    """ Generate the archive for the specific taskid and return the report of the generation """
+    return run_with_report(course.get_fs().prefix, taskid, course.get_id(), data["libraries_path"],
+                           data["resources_path"], data["tests_path"], data["archive_path"], requirements,
+                           PATH_TO_PLUGIN, index=get_course_index(course, data), compression=get_compression(data))
+
+
+def gen_task_job(course, taskid, data, requirements, progress):
+    """ Generation job of the archive of the specific taskid, see JobQueue.submit """
+    report = gen_task_archive(course, taskid, data, requirements)
+    progress(report)
+    return [report]
+
 
+def gen_all_archive(course, data, progress=None):
+    """ Generate the archive for all task inside the course and return the report of each task """
+    return run_all(course.get_fs().prefix, course.get_id(), data["libraries_path"], data["resources_path"],
+                   data["tests_path"], data['archive_path'], PATH_TO_PLUGIN,
+                   workers=data.get("workers", DEFAULT_CONFIG["workers"]), progress=progress,
+                   index=get_course_index(course, data), compression=get_compression(data))
 
-def gen_all_archive(course, data):
-    """ Generate the archive for all task inside the course """
-    run_all(course.get_fs().prefix, course.get_id(), data["libraries_path"], data["resources_path"], data["tests_path"], data['archive_path'], PATH_TO_PLUGIN)
 
+def verify_all_archive(course, data, deep=False, progress=None):
+    """ Verify the archives of all tasks inside the course, rebuild those that are not valid and return the reports """
+    return verify_all(course.get_fs().prefix, course.get_id(), data["libraries_path"], data["resources_path"],
+                      data["tests_path"], data["archive_path"], PATH_TO_PLUGIN, deep=deep,
+                      workers=data.get("workers", DEFAULT_CONFIG["workers"]), progress=progress,
+                      index=get_course_index(course, data), compression=get_compression(data))
 
-def has_archive(course, task_id, archive_location):
-    """ Check if an archive already exists or not """
-    archive_path = os.path.join(course.get_fs().prefix, task_id, archive_location)
-    return os.path.isfile(os.path.join(archive_path, course.get_id() + "_" + task_id + '.zip'))
+
+def get_job(course, job_id):
+    """ Get the generation job 'job_id' of the course, None if there is no such job """
+    try:
+        job = job_queue.get(int(job_id))
+    except ValueError:
+        return None
+    if job is None or job.course_id != course.get_id():
+        return None
+    return job
+
+
+def get_workers(input_data):
+    """ Get the number of archives to build concurrently from the submitted form """
+    try:
+        return max(1, int(input_data.get("workers", DEFAULT_CONFIG["workers"])))
+    except ValueError:
+        return DEFAULT_CONFIG["workers"]
+
+
+def get_compression(data):
+    """ Get the compression of each kind of entry of the archives from the configuration, see generator.run """
+    return {kind: data.get(kind + "_compression", DEFAULT_CONFIG[kind + "_compression"])
+            for kind in generator.DEFAULT_COMPRESSION}
+
+
+def get_compression_input(input_data, key):
+    """
+    Get the compression setting 'key' from the submitted form
+    :return: A tuple (setting, error), the default setting and the reason why the submitted one is not valid if it
+             is not, None otherwise
+    """
+    value = input_data.get(key, DEFAULT_CONFIG[key]).strip()
+    try:
+        generator.parse_compression(value)
+    except ValueError as e:
+        return DEFAULT_CONFIG[key], "{!r} is not valid ({}), {} is used instead".format(value, e, DEFAULT_CONFIG[key])
+    return value, None
+
+
+def get_selection(data):
+    """ Get the selection of the files put inside the projects from the configuration, see generator.run """
+    return {key: data.get(key, DEFAULT_CONFIG[key]) for key in generator.DEFAULT_SELECTION}
+
+
+def get_selection_input(input_data):
+    """ Get the selection of the files put inside the projects from the submitted form """
+    selection = {key: input_data.get(key, DEFAULT_CONFIG[key]).strip()
+                 for key in generator.DEFAULT_SELECTION if key.endswith(("_include", "_exclude"))}
+    try:
+        selection["libraries_max_size"] = max(0, int(input_data.get("libraries_max_size", "") or 0))
+    except ValueError:
+        selection["libraries_max_size"] = DEFAULT_CONFIG["libraries_max_size"]
+    selection["libraries_referenced_only"] = "libraries_referenced_only" in input_data
+    return selection
 
 
 def edit_configuration_file(course_factory, course, data):
-    """ Edit the configuration file with the new configuration """
+    """ Edit the configuration file with the new configuration, if it is not already the stored one """
+    if course.get_descriptor().get("intellij") == data:
+        return  # rewriting the descriptor would only make INGInious reload the course
     course_content = course_factory.get_course_descriptor_content(course.get_id())
     course_content["intellij"] = data
     course_factory.update_course_descriptor_content(course.get_id(), course_content)
+    watch_course(course, data)
+
+
+def watch_course(course, data):
+    """ (Re)start the watcher of the course with the configuration 'data', if the courses are watched """
+    if watch_settings is None:
+        return
+    watcher = _watchers.pop(course.get_id(), None)
+    if watcher is not None:
+        watcher.stop()
+    # the watchers only poll the files: the archives are rebuilt by the jobs of job_queue, whose workers are shared by
+    # all courses, instead of a pool per course
+    watcher = CourseWatcher(course.get_fs().prefix, course.get_id(), data["libraries_path"], data["resources_path"],
+                            data["tests_path"], data["archive_path"], PATH_TO_PLUGIN,
+                            interval=watch_settings["interval"], debounce=watch_settings["debounce"],
+                            workers=data.get("workers", DEFAULT_CONFIG["workers"]),
+                            compression=get_compression(data), selection=get_selection(data),
+                            rebuild=lambda tasks: submit_rebuild(course, data, tasks))
+    _watchers[course.get_id()] = watcher
+    watcher.start()
+
+
+def submit_rebuild(course, data, tasks):
+    """
+    Submit the jobs rebuilding the archives of the tasks of the course whose files changed, see CourseWatcher.
+    :param tasks: The ids of the tasks, None to rebuild the archives of all tasks that are not up to date
+    :return: The tasks whose archive is being built by a job started before the change, to submit again later
+    """
+    if tasks is None:
+        job_queue.submit(course.get_id(), None, gen_all_archive, course, data)
+        return []
+    retry = []
+    for task_id in tasks:
+        submitted = time.time()
+        job = job_queue.submit(course.get_id(), task_id, gen_task_job, course, task_id, data,
+                               get_requirements(course, task_id, data))
+        if job.started is not None and job.started < submitted:
+            retry.append(task_id)  # the running job may have read the files before they changed
+    return retry
 
 
 def get_configuration_file(course):
-    """ Get the actual configuration from the configuration file"""
-    return course.get_descriptor().get("intellij", DEFAULT_CONFIG)
+    """
+    Get the actual configuration from the configuration file, completed with the default configuration.
+    It is computed again only when the descriptor of the course changes, and must not be modified.
+    """
+    entry = course.get_descriptor().get("intellij")
+    cached = _configurations.get(course.get_id())
+    if cached is not None and cached[0] is entry:
+        return cached[1]
+    # INGInious loads a new descriptor when the course changes: the cached configuration is kept
+    # as long as the 'intellij' entry of the descriptor is the same object
+    data = dict(DEFAULT_CONFIG, **(entry or {}))
+    _configurations[course.get_id()] = (entry, data)
+    return data
 
 
 def task_menu(course, task, template_helper):
     """ Display (or not) the buttons in the task menu """
     data = get_configuration_file(course)
-    requirements = get_requirements(course, task.get_id(), data)
+    # this hook runs at each view of a task: the state of the task directories is cached for a few seconds
+    requirements, can_display = generator.get_task_facts(course.get_fs().prefix, task.get_id(), data["resources_path"],
+                                                         data["tests_path"], data["libraries_path"],
+                                                         data["archive_path"], selection=get_selection(data))
     requirements_ok = generator.process_requirements(requirements) and requirements['test_path'] and requirements['libs_path']
-    can_display = False
-    if requirements["resource_path"]:
-        can_display = generator.has_classes(course.get_fs().prefix, task.get_id(), data['resources_path'])
     return template_helper.render("task_menu.html", template_folder=os.path.join(PATH_TO_PLUGIN, 'templates'),
                                   plugin_path=PATH_TO_PLUGIN, course=course, task=task,
                                   libraries_path=data['libraries_path'], resources_path=data['resources_path'],
@@ -160,9 +387,26 @@ def course_admin_menu(course):
     return 'project_generator', '<i class="fa fa-file-archive-o fa-fw"></i>&nbsp; Project Generator'
 
 
-def init(plugin_manager, _, _2, _3):
+def init(plugin_manager, course_factory, _, config):
     plugin_manager.add_page('/plugins/<courseid>/<taskid>/project_generator', DownloadPage.as_view("pgdownloadpage"))
     plugin_manager.add_page('/admin/<course_id>/project_generator', ProjectGeneratorPage.as_view("pggeneratorpage"))
+    plugin_manager.add_page('/admin/<course_id>/project_generator/status',
+                            ProjectGeneratorStatusPage.as_view("pggeneratorstatuspage"))
     plugin_manager.add_hook('task_menu', task_menu)
     plugin_manager.add_hook('course_admin_menu', course_admin_menu)
+    # the projects with the same files, in any task of any course, are compressed once and shared
+    generator.ARCHIVE_STORE_PATH = config.get("store", None)
+    # the libraries compressed for the projects, in a temporary directory private to the process by default
+    generator.LIBS_BUNDLES_PATH = config.get("libs_cache", None)
+    if config.get("warm_up", False):
+        # check the archives of every course in the background, and build the missing, corrupt or stale ones
+        for course in course_factory.get_all_courses().values():
+            job_queue.submit(course.get_id(), None, verify_all_archive, course, get_configuration_file(course),
+                             kind="verification")
+    if config.get("watch", False):
+        # pre-generate the archives in the background, as soon as the files of the tasks change
+        global watch_settings
+        watch_settings = {"interval": config.get("watch_interval", 10), "debounce": config.get("watch_debounce", 5)}
+        for course in course_factory.get_all_courses().values():
+            watch_course(course, get_configuration_file(course))
 
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of INGInious. See the LICENSE and the COPYRIGHTS files for
+# more information about the licensing of this file.
+
+""" Asynchronous API of the generator, for asyncio applications """
+
+import asyncio
+import functools
+import threading
+
+from inginious_project_generator import generator
+
+
+class GenerationCancelled(generator.BuildCancelled):
+    """ Raised in the thread of a generation to stop it at the end of its current stage """
+
+
+async def generate_task(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path,
+                        plugin_path, force=False, compression=None, selection=None, executor=None):
+    """
+    Generate the archive of a task in a thread, without blocking the event loop.
+    The arguments are those of generator.run, 'executor' is the executor running the generation,
+    the default executor of the loop if not given.
+    When the coroutine is cancelled, the generation stops at the end of its current stage: the archive
+    is either left as it was or completely replaced.
+    :return: The report of the generation (see generator.run_with_report)
+    """
+    cancelled = threading.Event()
+    return await _run_cancellable(executor, cancelled, _generate_task, webdav_path, task_dir, course_id, libs_path,
+                                  resources_path, test_path, archive_path, plugin_path, force, compression,
+                                  selection, _listener(cancelled, None))
+
+
+async def generate_course(webdav_path, course_id, libs_path, resources_path, test_path, archive_path, plugin_path,
+                          force=False, compression=None, selection=None, concurrency=1, executor=None):
+    """
+    Generate the archives of all tasks of a course in threads, without blocking the event loop.
+    The arguments are those of generator.run_all, at most 'concurrency' archives of the course are built at once.
+    This is an asynchronous iterator of the events of the generation, dictionaries with the following keys:
+        event: 'started' when the generation of a task starts, 'stage' at the end of each of its stages
+               (see generator.run) and 'done' when it is finished
+        task: the name of the task
+        stage, metrics: for the 'stage' events, the name and the metrics of the stage
+        report: for the 'done' events, the report of the generation (see generator.run_with_report)
+    Stopping the iteration, or cancelling the task iterating, stops the generations at the end of their
+    current stage and does not start the other ones.
+    """
+    loop = asyncio.get_running_loop()
+    index = generator.CourseIndex(webdav_path, libs_path, resources_path, test_path, archive_path, selection)
+    await loop.run_in_executor(executor, index.refresh)
+    tasks = []
+    for task in index.get_tasks():
+        entry = index.get_task(task)
+        if generator.process_requirements(entry['requirement']) and entry['classes']:
+            tasks.append((task, entry['requirement']))
+    events = asyncio.Queue()
+    cancelled = threading.Event()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    def emit(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    async def build(task, requirement):
+        report = None
+        try:
+            async with semaphore:
+                events.put_nowait({'event': 'started', 'task': task})
+                report = await _run_cancellable(executor, cancelled, generator.run_with_report, webdav_path, task,
+                                                course_id, libs_path, resources_path, test_path, archive_path,
+                                                requirement, plugin_path, force, _listener(cancelled, emit), index,
+                                                compression)
+        finally:
+            events.put_nowait({'event': 'done', 'task': task, 'report': report})
+
+    builds = [asyncio.ensure_future(build(task, requirement)) for task, requirement in tasks]
+    try:
+        remaining = len(builds)
+        while remaining > 0:
+            event = await events.get()
+            if event['event'] == 'done':
+                remaining -= 1
+            yield event
+    finally:
+        cancelled.set()
+        for future in builds:
+            future.cancel()
+
+
+def _generate_task(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path, plugin_path,
+                   force, compression, selection, listener):
+    """
+    Check the requirements of the task and generate its archive, see generate_task
+    """
+    requirement = generator.check_requirements(webdav_path, task_dir, resources_path, test_path, libs_path,
+                                               archive_path)
+    if not generator.process_requirements(requirement):
+        return {'task': task_dir, 'status': 'failed', 'duration': 0.0, 'size': None, 'stages': {},
+                'error': 'Invalid paths: {}'.format(', '.join(sorted(key for key, ok in requirement.items()
+                                                                      if not ok)))}
+    return generator.run_with_report(webdav_path, task_dir, course_id, libs_path, resources_path, test_path,
+                                     archive_path, requirement, plugin_path, force, listener,
+                                     compression=compression, selection=selection)
+
+
+def _listener(cancelled, emit):
+    """
+    Listener of the stages of a generation (see generator.run) giving them to 'emit' as 'stage' events,
+    and stopping the generation once 'cancelled' is set, unless the archive is already published
+    """
+    def listener(task, stage, metrics):
+        if emit is not None:
+            emit({'event': 'stage', 'task': task, 'stage': stage, 'metrics': dict(metrics)})
+        if cancelled.is_set() and stage != 'publish':
+            raise GenerationCancelled('The generation of {} was cancelled'.format(task))
+    return listener
+
+
+async def _run_cancellable(executor, cancelled, function, *args):
+    """
+    Run 'function(*args)' in 'executor', and set 'cancelled' if the coroutine is cancelled
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(executor, functools.partial(function, *args))
+    except asyncio.CancelledError:
+        cancelled.set()
+        raise
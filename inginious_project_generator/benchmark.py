@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of INGInious. See the LICENSE and the COPYRIGHTS files for
+# more information about the licensing of this file.
+
+""" Benchmark of the project generator on synthetic courses """
+
+import os, json, time, shutil, argparse, tempfile, threading, statistics
+
+try:
+    import inginious_project_generator as plugin
+    from inginious_project_generator import generator
+except ImportError:
+    # without INGInious, the benchmark is run as a script next to generator.py and the hooks of the plugin are not
+    # measured
+    plugin = None
+    import generator
+
+PATH_TO_PLUGIN = os.path.dirname(os.path.abspath(generator.__file__))
+# the default structure of the courses, see DEFAULT_CONFIG of the plugin
+CONFIG = {
+    "resources_path": "public",
+    "tests_path": "unit_test",
+    "libraries_path": "$common/libs",
+    "archive_path": "public"
+}
+
+
+def make_course(course_path, tasks, java_files, tests, libraries, library_size):
+    """
+    Create a synthetic course in 'course_path', with the default structure of the plugin
+    :param tasks: The number of tasks
+    :param java_files: The number of java classes of each task
+    :param tests: The number of tests of each task
+    :param libraries: The number of jars in the libraries directory
+    :param library_size: The size in bytes of each jar
+    """
+    libs = os.path.join(course_path, CONFIG["libraries_path"])
+    os.makedirs(libs)
+    for i in range(libraries):
+        with open(os.path.join(libs, 'library{}-1.{}.jar'.format(i, i)), 'wb') as jar:
+            jar.write(os.urandom(library_size))  # jars are already compressed: random data is a good model
+    for i in range(tasks):
+        task = os.path.join(course_path, 'task{}'.format(i))
+        public = os.path.join(task, CONFIG["resources_path"])
+        unit_test = os.path.join(task, CONFIG["tests_path"])
+        os.makedirs(public)
+        os.makedirs(unit_test)
+        for j in range(java_files):
+            with open(os.path.join(public, 'Class{}.java'.format(j)), 'w') as file:
+                file.write('public class Class{} {{\n'.format(j) + '    int field;\n' * 50 + '}\n')
+        for j in range(tests):
+            with open(os.path.join(unit_test, 'Test{}.java'.format(j)), 'w') as file:
+                file.write('import org.junit.Test;\npublic class Test{} {{\n'.format(j) + '    @Test\n' * 20 + '}\n')
+
+
+def _io_counters():
+    """
+    The I/O counters of the process (read/write syscalls and bytes), None if the platform does not provide them
+    """
+    try:
+        with open('/proc/self/io') as file:
+            return {key: int(value) for key, value in (line.split(':') for line in file)}
+    except OSError:
+        return None
+
+
+class _ScandirIterator:
+    """ Iterator of os.scandir counting the calls of the stat method of its entries """
+
+    def __init__(self, iterator, counter):
+        self._iterator = iterator
+        self._counter = counter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return _DirEntry(next(self._iterator), self._counter)
+
+    def close(self):
+        self._iterator.close()
+
+
+class _DirEntry:
+    """ Entry of os.scandir counting the calls of its stat method """
+
+    def __init__(self, entry, counter):
+        self._entry = entry
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+    def __fspath__(self):
+        return self._entry.path
+
+    def stat(self, *args, **kwargs):
+        self._counter.add('stat')
+        return self._entry.stat(*args, **kwargs)
+
+
+class _CallCounter:
+    """
+    Count the calls reading the metadata of files (os.stat, os.lstat and the stat method of the entries of os.scandir,
+    also used by os.path) and listing directories (os.scandir, os.listdir), which /proc/self/io does not count.
+    The functions of the os module are replaced while the counter is used as a context manager.
+    """
+
+    _FUNCTIONS = {'stat': 'stat', 'lstat': 'stat', 'scandir': 'listdir', 'listdir': 'listdir'}
+
+    def __init__(self):
+        self.counts = {'stat': 0, 'listdir': 0}
+        self._lock = threading.Lock()
+        self._originals = {}
+
+    def add(self, kind):
+        with self._lock:
+            self.counts[kind] += 1
+
+    def __enter__(self):
+        for name, kind in self._FUNCTIONS.items():
+            self._originals[name] = getattr(os, name)
+            setattr(os, name, self._wrap(self._originals[name], kind, name == 'scandir'))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, function in self._originals.items():
+            setattr(os, name, function)
+
+    def _wrap(self, function, kind, scandir):
+        def counted(*args, **kwargs):
+            self.add(kind)
+            result = function(*args, **kwargs)
+            return _ScandirIterator(result, self) if scandir else result
+        return counted
+
+
+def measure(name, function, repeat):
+    """
+    Call 'function' 'repeat' times and measure its wall time and the I/O of the process, then call it once more to
+    count its stat and listdir calls (see _CallCounter), so that counting them does not change the measured time
+    """
+    durations = []
+    before = _io_counters()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    after = _io_counters()
+    result = {'name': name, 'repeat': repeat, 'min': min(durations), 'mean': statistics.mean(durations)}
+    if before is not None and after is not None:
+        for key in ('syscr', 'syscw', 'rchar', 'wchar'):
+            result[key] = (after[key] - before[key]) // repeat
+    with _CallCounter() as counter:
+        function()
+    result.update(counter.counts)
+    return result
+
+
+class _FileSystem:
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+
+class _Course:
+    """ The part of an INGInious course used by the plugin hooks """
+    def __init__(self, course_path, course_id):
+        self._fs = _FileSystem(course_path)
+        self._id = course_id
+
+    def get_fs(self):
+        return self._fs
+
+    def get_id(self):
+        return self._id
+
+    def get_descriptor(self):
+        return {"intellij": CONFIG}
+
+
+class _Task:
+    def __init__(self, task_id):
+        self._id = task_id
+
+    def get_id(self):
+        return self._id
+
+
+class _TemplateHelper:
+    """ Template helper rendering nothing, to only measure the plugin """
+    def render(self, *args, **kwargs):
+        return ''
+
+
+def run_benchmark(course_path, course_id, repeat, workers, compression=None):
+    """
+    Measure the generation of all archives, of one archive, the requirement checks and, if INGInious is installed,
+    the task menu hook
+    on the course 'course_path'
+    :param compression: The compression of each kind of entry of the archives (see generator.run)
+    :return: The list of measures
+    """
+    config = CONFIG
+    args = (course_path, course_id, config["libraries_path"], config["resources_path"], config["tests_path"],
+            config["archive_path"], PATH_TO_PLUGIN)
+    task = 'task0'
+    requirement = generator.check_requirements(course_path, task, config["resources_path"], config["tests_path"],
+                                               config["libraries_path"], config["archive_path"])
+    course, template_helper = _Course(course_path, course_id), _TemplateHelper()
+    results = [
+        measure('run_all (rebuild)', lambda: generator.run_all(*args, force=True, workers=workers,
+                                                                        compression=compression), repeat),
+        measure('run_all (up to date)', lambda: generator.run_all(*args, workers=workers,
+                                                                           compression=compression), repeat),
+        measure('run (rebuild)', lambda: generator.run(
+            course_path, task, course_id, config["libraries_path"], config["resources_path"], config["tests_path"],
+            config["archive_path"], requirement, PATH_TO_PLUGIN, True, compression=compression), repeat),
+        measure('check_requirements', lambda: generator.check_requirements(
+            course_path, task, config["resources_path"], config["tests_path"], config["libraries_path"],
+            config["archive_path"]), repeat * 100),
+        measure('get_task_facts', lambda: generator.get_task_facts(
+            course_path, task, config["resources_path"], config["tests_path"], config["libraries_path"],
+            config["archive_path"], ttl=0), repeat * 100),
+        measure('get_task_facts cached', lambda: generator.get_task_facts(
+            course_path, task, config["resources_path"], config["tests_path"], config["libraries_path"],
+            config["archive_path"]), repeat * 100)
+    ]
+    if plugin is not None:
+        results.append(measure('task_menu', lambda: plugin.task_menu(course, _Task(task), template_helper),
+                               repeat * 100))
+    sizes = [report['size'] for report in generator.run_all(*args, workers=workers, compression=compression)]
+    results.append({'name': 'archives', 'count': len(sizes), 'total_size': sum(sizes),
+                    'mean_size': statistics.mean(sizes) if sizes else 0})
+    return results
+
+
+def _print_results(results):
+    for result in results:
+        if 'count' in result:
+            print('{name:<22} {count} archives, {total_size} B in total, {mean_size:.0f} B on average'.format(**result))
+            continue
+        line = '{:<22} min {:10.3f} ms  mean {:10.3f} ms'.format(result['name'], result['min'] * 1000,
+                                                               result['mean'] * 1000)
+        line += '  {stat} stat {listdir} listdir'.format(**result)
+        if 'syscr' in result:
+            line += '  {syscr} read syscalls {syscw} write syscalls {rchar} B read {wchar} B written'.format(**result)
+        print(line)
+
+
+def process_args():
+    """
+    Get the arguments of the benchmark and run it
+    """
+    parser = argparse.ArgumentParser(prog="python3 -m inginious_project_generator.benchmark")
+    parser.add_argument('-t', '--tasks', help='The number of tasks of the course', default=50, type=int)
+    parser.add_argument('-f', '--java_files', help='The number of java classes of each task', default=5, type=int)
+    parser.add_argument('-u', '--tests', help='The number of tests of each task', default=3, type=int)
+    parser.add_argument('-l', '--libraries', help='The number of jars of the course', default=5, type=int)
+    parser.add_argument('-s', '--library_size', help='The size in bytes of each jar', default=500000, type=int)
+    parser.add_argument('-r', '--repeat', help='The number of times each measure is repeated', default=3, type=int)
+    parser.add_argument('-j', '--workers', help='The number of archives built concurrently', default=1, type=int)
+    parser.add_argument('-d', '--directory', help='Where the synthetic course is created (removed at the end)',
+                        default=None)
+    parser.add_argument('--sources_compression', help='The compression of the java files and of the pom.xml',
+                        default=generator.DEFAULT_COMPRESSION['sources'])
+    parser.add_argument('--libs_compression', help='The compression of the libraries',
+                        default=generator.DEFAULT_COMPRESSION['libs'])
+    parser.add_argument('--json', help='Print the results as JSON', default=False, action='store_true')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='project_generator_benchmark_', dir=args.directory)
+    try:
+        course_path = os.path.join(directory, 'BENCH')
+        make_course(course_path, args.tasks, args.java_files, args.tests, args.libraries, args.library_size)
+        results = run_benchmark(course_path, 'BENCH', max(1, args.repeat), args.workers,
+                                {'sources': args.sources_compression, 'libs': args.libs_compression})
+    finally:
+        shutil.rmtree(directory)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_results(results)
+
+
+if __name__ == '__main__':
+    process_args()
@@ -1,24 +1,78 @@
 #!/usr/bin/python
 
-import os, shutil, argparse
+import io, os, copy, json, time, shutil, struct, atexit, hashlib, logging, tempfile, threading, zipfile, argparse
+import contextlib
+import re, glob, fnmatch, functools, importlib
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from concurrent.futures import Future, ThreadPoolExecutor
 
+logger = logging.getLogger("inginious.webapp.plugin.project_generator")
+MANIFEST_VERSION = 1
+COPY_CHUNK_SIZE = 1024 * 1024
+COMPRESSION_METHODS = {'stored': zipfile.ZIP_STORED, 'deflated': zipfile.ZIP_DEFLATED, 'bzip2': zipfile.ZIP_BZIP2,
+                       'lzma': zipfile.ZIP_LZMA}
+# the module of the standard library needed by each compression method, which may be missing from a python build
+COMPRESSION_MODULES = {zipfile.ZIP_DEFLATED: 'zlib', zipfile.ZIP_BZIP2: 'bz2', zipfile.ZIP_LZMA: 'lzma'}
+# compression of each kind of entry: the java sources and the pom.xml, and the jars, which are already compressed
+DEFAULT_COMPRESSION = {'sources': 'deflated', 'libs': 'stored'}
+# directory of the bundles of the libraries, a new temporary directory private to the process if None
+LIBS_BUNDLES_PATH = None
+LIBS_BUNDLES_MAX_AGE = 24 * 3600  # seconds after which a bundle that is not used is removed
+_LIBS_BUNDLES = {}  # (libraries directory, compression) -> (signature, path to the bundle)
+_LIBS_BUNDLES_BUILDS = {}  # (libraries directory, compression) -> lock of the build of its bundle
+_LIBS_BUNDLES_DIRECTORY = None  # (LIBS_BUNDLES_PATH, directory of the bundles), see _libs_bundles_directory
+_LIBS_BUNDLES_LOCK = threading.Lock()
+_SPLICE_SUPPORTED = None  # whether _splice_raw_entries works with this version of zipfile, see _can_splice
+ARCHIVE_STORE_PATH = None  # directory of the content-addressed store of the archives, not used if None
+STORE_MAX_AGE = 30 * 24 * 3600  # seconds after which sources of the store that are not used can be collected
+FILE_FACTS_MAX_SIZE = 100000
+_FILE_FACTS = {}  # (kind of fact, path to a file) -> (size and modification time, fact about its content)
+_FILE_FACTS_LOCK = threading.Lock()
+# the files put in the projects, for each kind of input; the libraries can also be restricted to those below
+# a size in bytes (0 for no limit) and to those whose packages are imported by the classes or the tests, but those
+# always included, like the dependencies of other libraries that the sources never import
+DEFAULT_SELECTION = {
+    'resources_include': '*.java',
+    'resources_exclude': '',
+    'tests_include': '*.java',
+    'tests_exclude': '',
+    'libraries_include': '*.jar',
+    'libraries_exclude': '',
+    'libraries_max_size': 0,
+    'libraries_referenced_only': False,
+    'libraries_always_include': ''
+}
+_IMPORT = re.compile(r'^\s*import\s+(?:static\s+)?([\w.]+?)(?:\s*\.\s*\*)?\s*;', re.MULTILINE)
+TASK_FACTS_TTL = 10
+INDEXES_MAX_SIZE = 1000
+_INDEXES = {}  # (webdav and paths) -> index of the course
+_INDEXES_LOCK = threading.Lock()
+_BUILDS = {}  # path to an archive -> future result of the run building it
+_BUILDS_LOCK = threading.Lock()
+_POM_TEMPLATES = {}  # path to a pom.xml template -> (size and modification time, compiled template)
+_POM_TEMPLATES_LOCK = threading.Lock()
+# placeholders of the compiled pom.xml templates
+_POM_PROJECT, _POM_NAME, _POM_VERSION, _POM_FILE = '@@project@@', '@@name@@', '@@version@@', '@@file@@'
 
-def has_classes(webdav_path, task_path, resource_path):
+
+class BuildCancelled(Exception):
+    """ Raised by the listener of a generation (see run) to stop it at the end of its current stage """
+
+
+def has_classes(webdav_path, task_path, resource_path, selection=None):
     """
-    Check if the directory 'resource_path' has java files or not.
+    Check if the directory 'resource_path' has classes to put inside the project, as selected by 'selection'
+    (see run), like the 'classes' of the index of the course (see CourseIndex.get_task)
     """
     full_path = os.path.join(webdav_path, task_path, resource_path)
-    if not os.path.exists(full_path):
+    if not os.path.isdir(full_path):
         return False
-    files = os.listdir(full_path)
-    for file in files:
-        if '.java' in file:
-            return True
-    return False
+    return bool(_list_files(full_path, _without_archive(_get_selection(selection)['resources'], task_path)))
 
 
-def run_all(webdav_path, course_id, libs_path, resources_path, test_path, archive_path, plugin_path):
+def run_all(webdav_path, course_id, libs_path, resources_path, test_path, archive_path, plugin_path, force=False,
+            workers=1, progress=None, listener=None, index=None, compression=None, selection=None):
     """
     Create a IntelliJ project for all tasks inside the webdav
     :param webdav_path: A path to the webdav
@@ -28,122 +82,686 @@ def run_all(webdav_path, course_id, libs_path, resources_path, test_path, archiv
                             containing the java classes to be filled by students
     :param test_path: The path inside the task directory to the directory containing the tests
     :param archive_path: The path inside the task directory to the directory where the archive will be generated
+    :param force: Rebuild all archives, even those whose inputs did not change
+    :param workers: The number of archives built concurrently
+    :param progress: A function called with the report of each task as soon as it is done
+    :param listener: A function called with the metrics of each stage of each generation (see run)
+    :param index: The index of the course (see CourseIndex) to refresh and use, a new one is built if not given
+    :param compression: The compression of each kind of entry of the archives (see run)
+    :param selection: The files put in the projects (see run), used to build the index if it is not given
+    :return: The report of each task for which an archive was built, sorted by task (see run_with_report)
     """
-    dirs = os.listdir(webdav_path)
-    for dir in dirs:
-        full_path = os.path.join(webdav_path, dir)
-        if os.path.isdir(full_path):
-            requirement = check_requirements(webdav_path, dir, resources_path, test_path, libs_path, archive_path)
+    if index is None:
+        index = CourseIndex(webdav_path, libs_path, resources_path, test_path, archive_path, selection)
+    index.refresh()  # a single walk of the webdav gives the requirements and the files of all tasks
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = []
+        for dir in index.get_tasks():
+            entry = index.get_task(dir)
+            requirement = entry['requirement']
             if process_requirements(requirement):
-                if has_classes(webdav_path, dir, resources_path):
+                if entry['classes']:
                     # Create an archive only if classes are given to students
-                    run(webdav_path, dir, course_id, libs_path, resources_path, test_path, archive_path, requirement, plugin_path)
+                    future = pool.submit(run_with_report, webdav_path, dir, course_id, libs_path,
+                                         resources_path, test_path, archive_path, requirement, plugin_path, force,
+                                         listener, index, compression)
+                    if progress is not None:
+                        future.add_done_callback(lambda done: progress(done.result()))
+                    futures.append(future)
+        return [future.result() for future in futures]
+
+
+def find_courses(paths, default_config):
+    """
+    Find the courses to generate: each path is either a course directory (containing a course.yaml descriptor)
+    or an INGInious tasks directory whose sub-directories are courses
+    :param paths: The course or tasks directories
+    :param default_config: The settings used for the keys missing in the 'intellij' entry of a course descriptor
+    :return: A list of dictionaries with the id, the path, the settings of each course and the error raised while
+             reading its descriptor (None if it was read)
+    """
+    courses = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isfile(os.path.join(path, 'course.yaml')):
+            courses.append(_read_course(path, default_config))
+        elif os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.isfile(os.path.join(path, name, 'course.yaml')):
+                    courses.append(_read_course(os.path.join(path, name), default_config))
+        else:
+            courses.append({'course': os.path.basename(path), 'webdav_path': path, 'config': dict(default_config),
+                            'error': 'No such directory'})
+    return courses
+
+
+def _read_course(course_path, default_config):
+    """
+    Read the 'intellij' settings of the descriptor of the course in 'course_path'
+    """
+    course = {'course': os.path.basename(course_path), 'webdav_path': course_path, 'config': dict(default_config),
+              'error': None}
+    try:
+        import yaml  # only needed in batch mode, INGInious already depends on it
+        with open(os.path.join(course_path, 'course.yaml')) as file:
+            descriptor = yaml.safe_load(file) or {}
+        course['config'].update(descriptor.get('intellij') or {})
+    except Exception as e:
+        course['error'] = '{}: {}'.format(type(e).__name__, e)
+    return course
+
+
+def run_courses(courses, plugin_path, force=False, workers=1, progress=None, listener=None, verify=False,
+                repair=True, deep=False):
+    """
+    Create the IntelliJ projects of the tasks of several courses, with a single pool of workers for all of them
+    :param courses: The courses to generate (see find_courses)
+    :param force: Rebuild all archives, even those whose inputs did not change
+    :param workers: The number of archives built concurrently, over all the courses
+    :param progress: A function called with the course id and the report of each task as soon as it is done
+    :param listener: A function called with the metrics of each stage of each generation (see run)
+    :param verify: Verify the archives instead of generating them (see verify_task, with 'repair' and 'deep')
+    :return: A summary with the number of workers, the total duration and, for each course, its id, path, duration
+             (from the indexing of the course to the end of its last build), error and the report of each
+             of its tasks (see run_with_report and verify_task)
+    """
+    start = time.perf_counter()
+    summary = {'workers': max(1, workers), 'duration': 0.0, 'courses': []}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        scheduled = []
+        for course in courses:
+            result = {'course': course['course'], 'webdav_path': course['webdav_path'], 'duration': 0.0,
+                      'error': course['error'], 'reports': []}
+            summary['courses'].append(result)
+            if course['error'] is not None:
+                continue
+            config = course['config']
+            course_start = time.perf_counter()
+            try:
+                index = CourseIndex(course['webdav_path'], config['libraries_path'], config['resources_path'],
+                                    config['tests_path'], config['archive_path'], _course_selection(config))
+                index.refresh()
+                indexed = time.perf_counter()
+                futures, ends = [], []
+                for dir in index.get_tasks():
+                    entry = index.get_task(dir)
+                    if process_requirements(entry['requirement']) and entry['classes']:
+                        args = (course['webdav_path'], dir, course['course'], config['libraries_path'],
+                                config['resources_path'], config['tests_path'], config['archive_path'],
+                                entry['requirement'], plugin_path)
+                        if verify:
+                            future = pool.submit(verify_task, *args, repair, deep, listener, index,
+                                                 _course_compression(config))
+                        else:
+                            future = pool.submit(run_with_report, *args, force, listener, index,
+                                                 _course_compression(config))
+                        future.add_done_callback(lambda done, ends=ends: ends.append(time.perf_counter()))
+                        if progress is not None:
+                            future.add_done_callback(
+                                lambda done, course_id=course['course']: progress(course_id, done.result()))
+                        futures.append(future)
+            except Exception as e:
+                result['error'] = '{}: {}'.format(type(e).__name__, e)
+                indexed, futures, ends = time.perf_counter(), [], []
+            scheduled.append((result, course_start, indexed, futures, ends))
+        for result, course_start, indexed, futures, ends in scheduled:
+            result['reports'] = [future.result() for future in futures]
+            result['duration'] = max(ends, default=indexed) - course_start
+    summary['duration'] = time.perf_counter() - start
+    return summary
+
+
+def _course_compression(config):
+    """
+    The compression of each kind of entry (see run) set in the settings of a course
+    """
+    return {kind: config[kind + '_compression'] for kind in DEFAULT_COMPRESSION if kind + '_compression' in config}
+
+
+def _course_selection(config):
+    """
+    The selection of the files (see run) set in the settings of a course
+    """
+    return {key: config[key] for key in DEFAULT_SELECTION if key in config}
 
 
-def _create_structure(webdav_path, project_name):
+def run_with_report(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path, requirement,
+                    plugin_path, force=False, listener=None, index=None, compression=None, selection=None):
     """
-    Create the directory that will contain the project
+    Run the generation of the project of a task and report how it went instead of raising.
+    The report is a dictionary with the following keys:
+        task: the name of the task
+        status: 'generated', 'up_to_date' if the archive did not need to be rebuilt or 'failed'
+        duration: the time spent, in seconds
+        size: the size of the archive in bytes, None if there is no archive
+        error: the error message if the generation failed, None otherwise
+        stages: the metrics of each stage of the generation, by stage name (see _stage)
     """
-    new_dir = os.path.join(webdav_path, project_name)
-    if os.path.isdir(new_dir):
-        shutil.rmtree(new_dir)
-    os.mkdir(new_dir)
-    return new_dir
+    report = {'task': task_dir, 'status': 'failed', 'duration': 0.0, 'size': None, 'error': None, 'stages': {}}
 
+    def record(task, stage, metrics):
+        report['stages'][stage] = metrics
+        if listener is not None:
+            listener(task, stage, metrics)
 
-def gen_src(new_dir):
+    start = time.perf_counter()
+    try:
+        built = run(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path,
+                    requirement, plugin_path, force, record, index, compression, selection)
+        report['status'] = 'generated' if built else 'up_to_date'
+        project_name = course_id + '_' + task_dir
+        report['size'] = os.path.getsize(_archive_file(os.path.join(webdav_path, task_dir), archive_path,
+                                                       project_name))
+    except Exception as e:
+        report['error'] = '{}: {}'.format(type(e).__name__, e)
+    report['duration'] = time.perf_counter() - start
+    return report
+
+
+def verify_all(webdav_path, course_id, libs_path, resources_path, test_path, archive_path, plugin_path, repair=True,
+               deep=False, workers=1, progress=None, listener=None, index=None, compression=None, selection=None):
     """
-    Create a directory named src
+    Verify the archives of all tasks inside the webdav, and rebuild those that are not valid (see verify_task).
+    The archives that do not exist yet are built, so this also warms up a course that was just imported.
+    The arguments are those of run_all.
+    :return: The report of each task that has an archive, sorted by task (see verify_task)
     """
-    src = os.path.join(new_dir, 'src')
-    os.mkdir(src)
-    return src
+    if index is None:
+        index = CourseIndex(webdav_path, libs_path, resources_path, test_path, archive_path, selection)
+    index.refresh()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = []
+        for dir in index.get_tasks():
+            entry = index.get_task(dir)
+            if process_requirements(entry['requirement']) and entry['classes']:
+                future = pool.submit(verify_task, webdav_path, dir, course_id, libs_path, resources_path, test_path,
+                                     archive_path, entry['requirement'], plugin_path, repair, deep, listener, index,
+                                     compression)
+                if progress is not None:
+                    future.add_done_callback(lambda done: progress(done.result()))
+                futures.append(future)
+        return [future.result() for future in futures]
 
 
-def _gen_classes(webdav_path, src_folder, resource_path):
+def verify_task(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path, requirement,
+                plugin_path, repair=True, deep=False, listener=None, index=None, compression=None, selection=None):
     """
-    Copy all java files from 'resource_path' to the 'src/main' directory of the project
+    Verify the archive of a task: it must be a complete zip (its central directory is read), hold exactly the
+    entries of the project of the current files of the task, and have been built with the current configuration
+    (see run). Report how it went instead of raising, like run_with_report, with the following differences:
+        status: 'ok' if the archive is valid, 'repaired' if it was not and was rebuilt, the problem of the archive
+                if it was not valid and 'repair' is not set, or 'failed'
+        problem: 'missing', 'corrupt' or 'stale' if the archive was not valid, None otherwise
+        detail: what is wrong with the archive, None if it is valid
+    The stage 'verify' measures the check of the archive, the other stages are those of its rebuild.
+    :param repair: Rebuild the archive if it is not valid
+    :param deep: Also check the CRC of every entry, which reads and decompresses the whole archive
+    The other arguments are those of run.
     """
-    main_dir = os.path.join(src_folder, 'main')
-    os.mkdir(main_dir)
-    java_dir = os.path.join(main_dir, 'java')
-    os.mkdir(java_dir)
-    public = os.path.join(webdav_path, resource_path)
-    files = os.listdir(public)
+    report = {'task': task_dir, 'status': 'failed', 'problem': None, 'detail': None, 'duration': 0.0, 'size': None,
+              'error': None, 'stages': {}}
+
+    def record(task, stage, metrics):
+        report['stages'][stage] = metrics
+        if listener is not None:
+            listener(task, stage, metrics)
+
+    start = time.perf_counter()
+    try:
+        project_name = course_id + '_' + task_dir
+        webdav_task_dir = os.path.join(webdav_path, task_dir)
+        archive_file = _archive_file(webdav_task_dir, archive_path, project_name)
+        with _BUILDS_LOCK:
+            build = _BUILDS.get(os.path.abspath(archive_file))
+        if build is not None:
+            build.exception()  # check the archive once it is published, whether its build succeeded or not
+        with _stage(task_dir, 'verify', record) as metrics:
+            inputs, manifest = _scan_inputs(webdav_path, task_dir, course_id, libs_path, resources_path, test_path,
+                                            archive_path, requirement, plugin_path, index,
+                                            _get_compression(compression), selection)
+            report['problem'], report['detail'] = _check_archive(
+                archive_file, _expected_entries(inputs), _manifest_file(webdav_task_dir, archive_path, project_name),
+                manifest, deep, metrics)
+        report['status'] = report['problem'] or 'ok'
+        if report['problem'] is not None and repair:
+            run(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path, requirement,
+                plugin_path, True, record, index, compression, selection)
+            report['status'] = 'repaired'
+        if os.path.isfile(archive_file):
+            report['size'] = os.path.getsize(archive_file)
+    except Exception as e:
+        report['status'] = 'failed'
+        report['error'] = '{}: {}'.format(type(e).__name__, e)
+    report['duration'] = time.perf_counter() - start
+    return report
+
+
+def _check_archive(archive_file, entries, manifest_file, manifest, deep, metrics):
+    """
+    Check the archive of a project, see verify_task
+    :param entries: The names of the entries the archive must have (see _expected_entries)
+    :param manifest: The manifest of the current inputs of the archive (see _gen_manifest)
+    :param metrics: The metrics of the check, filled with the number of entries and the size of the archive
+    :return: A tuple (problem of the archive, what is wrong with it), (None, None) if it is valid
+    """
+    try:
+        if not _has_own_central_directory(archive_file):
+            return 'corrupt', 'The archive does not end with its central directory'
+        with zipfile.ZipFile(archive_file) as archive:  # fails if the central directory is incomplete
+            names = archive.namelist()
+            metrics['files'] = len(names)
+            metrics['bytes'] = os.path.getsize(archive_file)
+            bad = archive.testzip() if deep else None
+    except FileNotFoundError:
+        return 'missing', 'There is no archive'
+    except Exception as e:  # anything raised while reading the archive means that it is damaged
+        return 'corrupt', '{}: {}'.format(type(e).__name__, e)
+    if bad is not None:
+        return 'corrupt', 'Bad CRC or local header of the entry {}'.format(bad)
+    if len(set(names)) != len(names):
+        return 'corrupt', 'Duplicate entries'
+    missing, unexpected = sorted(entries.difference(names)), sorted(set(names).difference(entries))
+    if missing or unexpected:
+        return 'stale', '; '.join('{} entries: {}'.format(kind, ', '.join(files))
+                                  for kind, files in (('Missing', missing), ('Unexpected', unexpected)) if files)
+    if _read_manifest(manifest_file) != manifest:
+        return 'stale', 'The files or the configuration changed since the archive was built'
+    return None, None
+
+
+def _has_own_central_directory(archive_file):
+    """
+    Check that the archive ends with its end of central directory record (the archives have no comment), and that
+    this record locates the central directory right before it, from the start of the file.
+    A truncated archive can end inside a stored jar: zipfile then finds the central directory of the jar and reads
+    it as the one of the archive, with the jar as the only content.
+    """
+    with open(archive_file, 'rb') as file:
+        end = file.seek(0, os.SEEK_END) - 22
+        if end < 0:
+            return False
+        file.seek(end)
+        signature, _, _, _, count, size, offset, comment_length = struct.unpack('<4s4H2LH', file.read(22))
+        if signature != b'PK\x05\x06' or comment_length != 0:
+            return False
+        if count == 0xFFFF or size == 0xFFFFFFFF or offset == 0xFFFFFFFF:
+            # zip64: the locator before the record gives the position of the zip64 end of central directory record
+            if end < 20:
+                return False
+            file.seek(end - 20)
+            signature, _, end, _ = struct.unpack('<4sLQL', file.read(20))
+            if signature != b'PK\x06\x07':
+                return False
+            file.seek(end)
+            record = file.read(56)
+            if len(record) != 56:
+                return False
+            signature, _, _, _, _, _, _, _, size, offset = struct.unpack('<4sQ2H2L4Q', record)
+            if signature != b'PK\x06\x06':
+                return False
+        return offset + size == end
+
+
+def summarize_stages(reports):
+    """
+    Sum the metrics of each stage over the reports of several generations
+    :return: A list of dictionaries with the name of the stage, the number of generations that went through it,
+             their total duration, files and bytes, the compressed size of the entries they added to the archives
+             (None for the stages adding no entries) and their number of cache hits, in the order of the stages
+    """
+    summary = {}
+    for report in reports:
+        for stage, metrics in report.get('stages', {}).items():
+            total = summary.setdefault(stage, {'stage': stage, 'count': 0, 'duration': 0.0, 'files': 0, 'bytes': 0,
+                                               'compressed': None, 'cache_hits': 0})
+            total['count'] += 1
+            total['duration'] += metrics['duration']
+            total['files'] += metrics['files']
+            total['bytes'] += metrics['bytes']
+            if 'compressed' in metrics:
+                total['compressed'] = (total['compressed'] or 0) + metrics['compressed']
+            total['cache_hits'] += 1 if metrics.get('cache_hit') else 0
+    return list(summary.values())
+
+
+def _print_report(reports, stages=False):
+    """
+    Print a line for each task report, followed by the summary of the stages if 'stages' is set
+    """
+    for report in reports:
+        size = '-' if report['size'] is None else '{} B'.format(report['size'])
+        status = report['status']
+        if report.get('problem') not in (None, status):
+            status += ' ' + report['problem']  # the archive was repaired, or its repair failed
+        error = report['error'] or report.get('detail')
+        print('[{}] {} in {:.3f}s ({}){}'.format(report['task'], status, report['duration'], size,
+                                                  '' if error is None else ': ' + error))
+    if stages:
+        _print_stages(reports)
+
+
+def _print_stages(reports):
+    """
+    Print the summary of the stages of the generations of the reports
+    """
+    for total in summarize_stages(reports):
+        print('{stage:<12} {duration:8.3f}s {count:5} runs {files:7} files {bytes:12} bytes {:>12} compressed '
+              '{cache_hits:5} cache hits'.format('-' if total['compressed'] is None else total['compressed'], **total))
+
+
+def parse_compression(value):
+    """
+    Parse a compression setting: the name of a method of COMPRESSION_METHODS ('stored', 'deflated', 'bzip2' or
+    'lzma'), optionally followed by a compression level, like 'deflated:9'
+    :return: A tuple (zipfile compression method, compression level or None for the default level of the method)
+    :raise ValueError: If the method is unknown or not available, or if the level is not valid for the method
+    """
+    name, _, level = str(value).strip().lower().partition(':')
+    if name not in COMPRESSION_METHODS:
+        raise ValueError('Unknown compression method {!r}, expected one of {}'.format(
+            name, ', '.join(COMPRESSION_METHODS)))
+    method = COMPRESSION_METHODS[name]
+    if method in COMPRESSION_MODULES:
+        try:
+            importlib.import_module(COMPRESSION_MODULES[method])
+        except ImportError:
+            raise ValueError('The compression method {} needs the module {}, which is not available'.format(
+                name, COMPRESSION_MODULES[method]))
+    if not level:
+        return method, None
+    levels = {zipfile.ZIP_DEFLATED: range(0, 10), zipfile.ZIP_BZIP2: range(1, 10)}.get(method, range(0))
+    if not level.isdigit() or int(level) not in levels:
+        raise ValueError('Invalid compression level {!r} for {}'.format(level, name))
+    return method, int(level)
+
+
+def _get_compression(compression):
+    """
+    Parse the compression of each kind of entry (see DEFAULT_COMPRESSION and parse_compression),
+    the kinds missing from 'compression' get their default compression
+    """
+    settings = dict(DEFAULT_COMPRESSION, **(compression or {}))
+    return {kind: parse_compression(settings[kind]) for kind in DEFAULT_COMPRESSION}
+
+
+def _open_archive(archive):
+    """
+    Open the zip archive in which the project entries will be streamed
+    """
+    return zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED)
+
+
+def _add_directory(archive, arcname):
+    """
+    Add an empty directory entry named 'arcname' to the archive
+    """
+    info = zipfile.ZipInfo(arcname.rstrip('/') + '/', time.localtime()[:6])
+    info.external_attr = (0o40755 << 16) | 0x10  # drwxr-xr-x and the MS-DOS directory flag
+    archive.writestr(info, b'', compress_type=zipfile.ZIP_STORED)
+
+
+def _add_files(archive, directory, arcdir, files, compression):
+    """
+    Stream the files 'files' of 'directory' into the archive under the directory 'arcdir'
+    :param compression: The compression method and level of the entries (see parse_compression)
+    :return: The number of bytes added
+    """
+    size = 0
     for file in files:
-        full_path = os.path.join(public, file)
-        if os.path.isfile(full_path) and '.java' in file:
-            shutil.copy(full_path, java_dir)
+        archive.write(os.path.join(directory, file), arcdir + '/' + file, *compression)
+        size += archive.filelist[-1].file_size
+    return size
 
 
-def _gen_tests(webdav_path, src_folder, test_path, has_tests):
+def _entries_size(archive, first):
     """
-    Copy all test files from 'test_path' to the 'src/test' directory of the project
+    Sum the sizes of the entries of the archive from the 'first'-th one
+    :return: A tuple (uncompressed size, compressed size)
     """
-    main_dir = os.path.join(src_folder, 'test')
-    os.mkdir(main_dir)
-    java_dir = os.path.join(main_dir, 'java')
-    os.mkdir(java_dir)
-    if has_tests:
-        unit_test = os.path.join(webdav_path, test_path)
-        files = os.listdir(unit_test)
-        for file in files:
-            full_path = os.path.join(unit_test, file)
-            if os.path.isfile(full_path) and '.java' in full_path:
-                shutil.copy(full_path, java_dir)
+    entries = archive.filelist[first:]
+    return sum(info.file_size for info in entries), sum(info.compress_size for info in entries)
 
 
-def _gen_libs(webdav_path, new_dir, libs_path, has_libs):
+def _list_files(directory, patterns):
     """
-    Copy all libraries from 'libs_path' to the 'libs' directory of the project
+    List the regular files of 'directory' selected by 'patterns' (see _is_selected)
     """
-    directory = os.path.join(webdav_path, libs_path)
-    libs = os.path.join(new_dir, 'libs')
-    os.mkdir(libs)
-    if has_libs:
-        files = os.listdir(directory)
-        for file in files:
-            full_path = os.path.join(directory, file)
-            if os.path.isfile(full_path):
-                shutil.copy(full_path, libs)
-        return files
-    else:
-        return []
+    files = []
+    for file in sorted(os.listdir(directory)):
+        if os.path.isfile(os.path.join(directory, file)) and _is_selected(file, patterns):
+            files.append(file)
+    return files
+
+
+def _is_selected(name, patterns):
+    """
+    Check if the file 'name' is put inside the projects: 'patterns' is a pair of lists of glob patterns,
+    the file must match one of the first ones and none of the second ones. Hidden files never are.
+    """
+    include, exclude = patterns
+    return not name.startswith('.') and any(fnmatch.fnmatchcase(name, pattern) for pattern in include) \
+        and not any(fnmatch.fnmatchcase(name, pattern) for pattern in exclude)
 
 
-def _gen_target(src_foler):
+def _get_selection(selection):
     """
-    Create the 'target' directory and subdirectories
+    Parse the selection of the files (see DEFAULT_SELECTION), the settings missing from 'selection' get their
+    default value. The patterns are lists, or strings separating them with commas.
+    :return: A dictionary with the include and exclude patterns of each kind of input ('resources', 'tests' and
+             'libraries', see _is_selected), the maximum size of the libraries ('max_size') and whether only the
+             libraries referenced by the sources are selected ('referenced_only'), except those matching one of
+             the patterns 'always'
+    :raise ValueError: If the maximum size is not an integer
     """
-    target = os.path.join(src_foler, 'target')
-    os.mkdir(target)
+    settings = dict(DEFAULT_SELECTION, **(selection or {}))
+    parsed = {kind: [_parse_patterns(settings[kind + '_include']), _parse_patterns(settings[kind + '_exclude'])]
+              for kind in ('resources', 'tests', 'libraries')}
+    try:
+        parsed['max_size'] = max(0, int(settings['libraries_max_size'] or 0))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid libraries_max_size {!r}, expected a number of bytes'.format(
+            settings['libraries_max_size']))
+    referenced_only = settings['libraries_referenced_only']
+    if isinstance(referenced_only, str):
+        referenced_only = referenced_only.strip().lower() in ('1', 'true', 'yes', 'on')
+    parsed['referenced_only'] = bool(referenced_only)
+    parsed['always'] = _parse_patterns(settings['libraries_always_include'])
+    return parsed
+
+
+def _parse_patterns(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return sorted(pattern.strip() for pattern in value if pattern.strip())
+
+
+def _select_libraries(libraries, stats, sources, selection):
+    """
+    Restrict the libraries 'stats' (see _stat_files) of the directory 'libraries' to those below the maximum size
+    of the 'selection' (see _get_selection) and, if it is set, to those having a package imported by one of the
+    java files 'sources', a list of (path, stats) pairs. The imports do not tell the dependencies between libraries
+    (junit needs hamcrest-core, which the tests never import): the libraries matching the patterns 'always' of the
+    selection are kept anyway.
+    """
+    if selection['max_size']:
+        stats = {name: stat for name, stat in stats.items() if stat[0] <= selection['max_size']}
+    if selection['referenced_only'] and stats:
+        imported = set()
+        for path, stat in sources:
+            imported.update(_file_fact(_java_imports, path, stat))
+        selected = {}
+        for name, stat in stats.items():
+            packages = _file_fact(_jar_packages, os.path.join(libraries, name), stat)
+            # the libraries that cannot be read are kept, they may be needed
+            if packages is None or not packages.isdisjoint(imported) \
+                    or any(fnmatch.fnmatchcase(name, pattern) for pattern in selection['always']):
+                selected[name] = stat
+        stats = selected
+    return stats
+
+
+def _java_imports(path):
+    """
+    The packages a java file may import from: every prefix of the names of its imports
+    """
+    with open(path, encoding='utf-8', errors='replace') as file:
+        source = file.read()
+    prefixes = set()
+    for name in _IMPORT.findall(source):
+        parts = name.split('.')
+        prefixes.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    return frozenset(prefixes)
+
+
+def _jar_packages(path):
+    """
+    The packages of the classes of a jar, None if it cannot be read
+    """
+    try:
+        with zipfile.ZipFile(path) as jar:
+            return frozenset(os.path.dirname(name).replace('/', '.') for name in jar.namelist()
+                             if name.endswith('.class') and '/' in name)
+    except (OSError, zipfile.BadZipFile):
+        return None
+
+
+def _gen_classes(archive, public, files, compression):
+    """
+    Add the java files 'files' of the directory 'public' to the 'src/main/java' directory of the project
+    """
+    _add_directory(archive, 'src/main')
+    _add_directory(archive, 'src/main/java')
+    return _add_files(archive, public, 'src/main/java', files, compression)
+
+
+def _gen_tests(archive, unit_test, files, compression):
+    """
+    Add the test files 'files' of the directory 'unit_test' to the 'src/test/java' directory of the project
+    """
+    _add_directory(archive, 'src/test')
+    _add_directory(archive, 'src/test/java')
+    return _add_files(archive, unit_test, 'src/test/java', files, compression)
+
+
+def _gen_libs(archive, bundle):
+    """
+    Add the libraries of the open bundle 'bundle' (see _get_libs_bundle) to the 'libs' directory of the project
+    """
+    _add_directory(archive, 'libs')
+    if bundle is not None:
+        return _splice_entries(archive, bundle)
+    return 0
+
+
+def _gen_target(archive):
+    """
+    Add the 'target' directory and subdirectories
+    """
+    _add_directory(archive, 'target')
     dirs = ['classes', 'generated-sources', 'generated-test-sources', 'test-classes']
     for direct in dirs:
-        os.mkdir(os.path.join(target, direct))
+        _add_directory(archive, 'target/' + direct)
+
+
+def _expected_entries(inputs):
+    """
+    The names of the entries of the project of the files 'inputs' (see _scan_inputs), as written by _build
+    """
+    entries = {'src/', 'src/main/', 'src/main/java/', 'src/test/', 'src/test/java/', 'libs/', 'target/', 'pom.xml'}
+    entries.update('target/' + direct + '/' for direct in ('classes', 'generated-sources', 'generated-test-sources',
+                                                           'test-classes'))
+    for kind, arcdir in (('resources', 'src/main/java'), ('tests', 'src/test/java'), ('libs', 'libs')):
+        entries.update(arcdir + '/' + file for file in inputs[kind][1])
+    return entries
+
+
+def _gen_pom(archive, project_name, libs, has_libs, plugin_path, compression):
+    """
+    Render the pom.xml file of the plugin into the archive,
+    filled with the name of the project and the dependencies of the libraries
+    :return: The size of the pom.xml file
+    """
+    template = _get_pom_template(plugin_path)
+    pom = _render_pom(template, project_name, tuple(libs) if has_libs else ())
+    info = zipfile.ZipInfo('pom.xml', time.localtime()[:6])
+    info.external_attr = 0o644 << 16
+    archive.writestr(info, pom, *compression)
+    return len(pom)
 
 
-def _gen_pom(new_dir, project_name, libs, has_libs, plugin_path):
+def _get_pom_template(plugin_path):
     """
-    Copy the pom.xml file into the project directory
-    and fill it correctly with the name of the project and the dependencies of the libraries
+    Get the pom.xml template of the plugin, parsed and prepared once (see _compile_pom_template)
+    and compiled again only if the file changes
     """
-    shutil.copy(os.path.join(plugin_path, 'pom.xml'), new_dir)
-    pom = os.path.join(new_dir, 'pom.xml')
-    tree = ET.parse(pom)
-    root = tree.getroot()
-    # Add the name of the project to the pom.xml
-    artifact_id = root.find('artifactId')
-    group_id = root.find('groupId')
-    group_id.text = project_name
-    artifact_id.text = project_name
-    if has_libs:
-        _put_dependencies(libs, root)
-    # Add these lines to the top of the pom
-    root.set('xmlns', 'http://maven.apache.org/POM/4.0.0')
-    root.set('xmlns:xsi', 'http://www.w3.org/2001/XMLSchema-instance')
-    root.set('xsi:schemaLocation', 'http://maven.apache.org/POM/4.0.0 http://maven.apache.org/xsd/maven-4.0.0.xsd')
-    _indent(root)
-    tree.write(pom, encoding="UTF-8", xml_declaration=True)
+    path = os.path.join(plugin_path, 'pom.xml')
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    with _POM_TEMPLATES_LOCK:
+        template = _POM_TEMPLATES.get(path)
+        if template is None or template[0] != signature:
+            template = _POM_TEMPLATES[path] = (signature, _compile_pom_template(path))
+        return template[1]
+
+
+def _compile_pom_template(path):
+    """
+    Turn the pom.xml file 'path' into text templates with the output of the former parse, fill, indent and write
+    steps. Placeholders are filled in, serialized and indented, then the text is cut around them.
+    :return: A tuple (pom without dependencies, text before the dependencies, template of a dependency,
+             text between two dependencies, text after the dependencies)
+    """
+    def serialize(dependencies):
+        root = ET.parse(path).getroot()
+        # Add the name of the project to the pom.xml
+        root.find('groupId').text = _POM_PROJECT
+        root.find('artifactId').text = _POM_PROJECT
+        if dependencies:
+            _put_dependencies(dependencies, root)
+        # Add these lines to the top of the pom
+        root.set('xmlns', 'http://maven.apache.org/POM/4.0.0')
+        root.set('xmlns:xsi', 'http://www.w3.org/2001/XMLSchema-instance')
+        root.set('xsi:schemaLocation', 'http://maven.apache.org/POM/4.0.0 http://maven.apache.org/xsd/maven-4.0.0.xsd')
+        _indent(root)
+        return ET.tostring(root, encoding='UTF-8', xml_declaration=True).decode('utf-8')
+
+    empty = serialize(())
+    # two dependencies give both the text between dependencies and the one after the last dependency
+    pom = serialize(((_POM_NAME, _POM_VERSION, _POM_FILE),) * 2)
+    start = pom.find('<dependency>')
+    if start < 0:
+        return empty, None, None, None, None  # the pom.xml is broken, it has no dependencies (logged above)
+    end = pom.index('</dependency>') + len('</dependency>')
+    second = pom.index('<dependency>', end)
+    after = pom.index('</dependency>', second) + len('</dependency>')
+    return empty, pom[:start], pom[start:end], pom[end:second], pom[after:]
+
+
+def _render_pom(template, project_name, dependencies):
+    """
+    Fill the compiled pom.xml 'template' with the name of the project and the 'dependencies'
+    (see _parse_dependencies), as a tuple
+    :return: The content of the pom.xml file, in UTF-8
+    """
+    empty, before, _, _, after = template
+    if not dependencies or before is None:
+        pom = empty
+    else:
+        pom = before + _render_dependencies(template, dependencies) + after
+    return pom.replace(_POM_PROJECT, escape(project_name)).encode('utf-8')
+
+
+@functools.lru_cache(maxsize=64)
+def _render_dependencies(template, dependencies):
+    """
+    Render the 'dependencies' of the compiled pom.xml 'template'.
+    The fragment is shared by all the projects using the same libraries, so it is rendered once.
+    """
+    _, _, dependency, between, _ = template
+    return between.join(dependency.replace(_POM_NAME, escape(name))
+                        .replace(_POM_VERSION, escape(v))
+                        .replace(_POM_FILE, escape(fname))
+                        for name, v, fname in dependencies)
 
 
 def _indent(elem, level=0):
@@ -166,14 +784,11 @@ def _indent(elem, level=0):
             elem.tail = i
 
 
-def _put_dependencies(libs, root):
+def _parse_dependencies(libs):
     """
-    Put the correct dependencies corresponding to all libraries of the project inside the 'pom.xml'
+    Get the name, the version and the file name (without extension) of the dependency corresponding to each library
     """
-    dependencies = root.find('dependencies')
-    if dependencies is None:
-        print("The pom.xml file is broken")
-        return
+    dependencies = []
     for lib in libs:
         fname = os.path.splitext(os.path.basename(lib))[0]
         v = '0.0.0'
@@ -181,6 +796,19 @@ def _put_dependencies(libs, root):
         if '-' in fname:
             v = str.split(fname, '-')[-1]
             name = fname.replace('-' + v, '')
+        dependencies.append((name, v, fname))
+    return dependencies
+
+
+def _put_dependencies(libs, root):
+    """
+    Put the dependencies 'libs' (see _parse_dependencies) of all libraries of the project inside the 'pom.xml'
+    """
+    dependencies = root.find('dependencies')
+    if dependencies is None:
+        logger.warning("The pom.xml file is broken")
+        return
+    for name, v, fname in libs:
         dependency = ET.SubElement(dependencies, 'dependency')
         group_id = ET.SubElement(dependency, 'groupId')
         group_id.text = name
@@ -194,21 +822,412 @@ def _put_dependencies(libs, root):
         system_path.text = '${project.basedir}/libs/' + fname + '.jar'
 
 
-def _gen_archive(new_dir, webdav_task_dir, archive_path,  project_name):
+def _get_libs_bundle(directory, stats, compression):
+    """
+    Get the bundle of the libraries 'stats' (see _stat_files) of 'directory': a zip holding the compressed
+    'libs/' entries of the project, shared by all the projects using these libraries.
+    The bundle is built once by the process and rebuilt only when the content of the directory or the compression
+    changes. The bundles of different directories are built concurrently.
+    :param compression: The compression method and level of the libraries (see parse_compression)
+    :return: A tuple (bundle opened for reading, True if the bundle was built by this call). The bundle can be read
+             until it is closed, even if it is replaced or removed in the meantime.
+    """
+    key = (os.path.abspath(directory),) + tuple(compression)
+    signature = hashlib.sha1(json.dumps([key, stats], sort_keys=True).encode('utf-8')).hexdigest()
+    with _LIBS_BUNDLES_LOCK:
+        lock = _LIBS_BUNDLES_BUILDS.setdefault(key, threading.Lock())
+    with lock:
+        bundles = _libs_bundles_directory()
+        path = os.path.join(bundles, signature + '.zip')
+        previous = _LIBS_BUNDLES.get(key)
+        if previous == (signature, path):
+            try:
+                source = open(path, 'rb')
+                os.utime(source.fileno())  # used: not pruned
+                return source, False
+            except FileNotFoundError:
+                pass  # pruned by another process sharing the directory
+        # only the bundles built by the process are used, never a file found in the directory
+        building = _temporary_file(path)
+        try:
+            with zipfile.ZipFile(building, 'w') as libs:
+                _add_files(libs, directory, 'libs', sorted(stats), compression)
+            os.replace(building, path)
+        except BaseException:
+            if os.path.isfile(building):
+                os.remove(building)
+            raise
+        source = open(path, 'rb')
+        with _LIBS_BUNDLES_LOCK:
+            _LIBS_BUNDLES[key] = (signature, path)
+        if previous is not None and previous[1] != path:
+            _remove_quietly(previous[1])  # outdated: the projects still reading it have it open
+        _prune_libs_bundles(bundles)
+        return source, True
+
+
+def _libs_bundles_directory():
+    """
+    The directory of the bundles of the libraries: LIBS_BUNDLES_PATH, or a new temporary directory private to
+    the process and removed at its exit if it is None
+    :raise PermissionError: If LIBS_BUNDLES_PATH is not owned by the user running the generator,
+                            or if other users can write in it
+    """
+    global _LIBS_BUNDLES_DIRECTORY
+    with _LIBS_BUNDLES_LOCK:
+        if _LIBS_BUNDLES_DIRECTORY is None or _LIBS_BUNDLES_DIRECTORY[0] != LIBS_BUNDLES_PATH:
+            if LIBS_BUNDLES_PATH is None:
+                directory = tempfile.mkdtemp(prefix='inginious_project_generator_libs_')  # only readable by us
+                atexit.register(shutil.rmtree, directory, True)
+            else:
+                directory = _private_directory(LIBS_BUNDLES_PATH, 'the bundles of the libraries')
+            _LIBS_BUNDLES_DIRECTORY = (LIBS_BUNDLES_PATH, directory)
+        return _LIBS_BUNDLES_DIRECTORY[1]
+
+
+def _private_directory(directory, content, create=True):
+    """
+    Create the directory 'directory' if it does not exist, only accessible by the user running the generator,
+    and check that nobody else can put files in it: its files are copied as they are into the archives
+    :param content: What the directory holds, for the error message
+    :param create: If False, the directory is only checked
+    :return: The directory
+    :raise FileNotFoundError: If 'create' is False and the directory does not exist
+    :raise PermissionError: If the directory is not owned by the user running the generator, or if other users can
+                            write in it
+    """
+    if create:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    stat = os.stat(directory)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        raise PermissionError('The directory of {} {} must be owned by the user running the generator, and only '
+                              'writable by them'.format(content, directory))
+    return directory
+
+
+def _prune_libs_bundles(directory):
+    """
+    Remove the files of the directory of the bundles that were not used for LIBS_BUNDLES_MAX_AGE seconds,
+    except the current bundles of the process
+    """
+    limit = time.time() - LIBS_BUNDLES_MAX_AGE
+    with _LIBS_BUNDLES_LOCK:
+        current = {path for _, path in _LIBS_BUNDLES.values()}
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if path not in current and os.stat(path).st_mtime < limit:
+                os.remove(path)
+        except FileNotFoundError:
+            pass  # removed by another process sharing the directory
+
+
+def _remove_quietly(path):
+    """
+    Remove the file 'path' if it still exists
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _splice_entries(archive, raw):
+    """
+    Append the entries of the zip 'raw', an open binary file, to 'archive' as they are, without decompressing and
+    recompressing them, if this version of zipfile allows it (see _can_splice). Otherwise they are decompressed
+    and compressed again with the same method.
+    :return: The number of bytes added
+    """
+    if _can_splice():
+        return _splice_raw_entries(archive, raw)
+    return _copy_entries(archive, raw)
+
+
+def _can_splice():
+    """
+    Check once that _splice_raw_entries, which relies on the internals of zipfile, works with its current version:
+    it must splice a small zip between two entries of another one, and give a valid zip
+    """
+    global _SPLICE_SUPPORTED
+    if _SPLICE_SUPPORTED is None:
+        try:
+            source, target = io.BytesIO(), io.BytesIO()
+            with zipfile.ZipFile(source, 'w') as test:
+                test.writestr('spliced', b'spliced' * 100, zipfile.ZIP_DEFLATED)
+            with zipfile.ZipFile(target, 'w') as test:
+                test.writestr('first', b'first')
+                _splice_raw_entries(test, source)
+                test.writestr('last', b'last')
+            with zipfile.ZipFile(target) as test:
+                supported = test.testzip() is None and test.namelist() == ['first', 'spliced', 'last'] \
+                    and test.read('spliced') == b'spliced' * 100
+        except Exception:
+            supported = False
+        if not supported:
+            logger.warning('The entries of the bundles are compressed again: this version of zipfile does not '
+                           'allow to copy them')
+        _SPLICE_SUPPORTED = supported
+    return _SPLICE_SUPPORTED
+
+
+def _splice_raw_entries(archive, raw):
+    """
+    Append the entries of the zip 'raw' to 'archive' by copying their compressed data, see _splice_entries
+    """
+    size = 0
+    with zipfile.ZipFile(raw) as source:
+        for info in source.infolist():
+            # skip the local header of the entry to get to its compressed data
+            raw.seek(info.header_offset)
+            header = raw.read(zipfile.sizeFileHeader)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            raw.seek(name_length + extra_length, os.SEEK_CUR)
+            entry = copy.copy(info)
+            entry.extra = b''  # the zip64 extra field, if needed, is written again by FileHeader
+            entry.flag_bits &= ~0x08  # sizes and CRC are known: no data descriptor
+            entry.header_offset = archive.fp.tell()
+            archive.fp.write(entry.FileHeader())
+            remaining = info.compress_size
+            while remaining > 0:
+                chunk = raw.read(min(remaining, COPY_CHUNK_SIZE))
+                if not chunk:
+                    raise zipfile.BadZipFile('Truncated entry {} in {}'.format(info.filename,
+                                                                               getattr(raw, 'name', 'the bundle')))
+                archive.fp.write(chunk)
+                remaining -= len(chunk)
+            size += info.compress_size
+            archive.filelist.append(entry)
+            archive.NameToInfo[entry.filename] = entry
+            archive.start_dir = archive.fp.tell()
+    archive._didModify = True  # make sure the central directory is written with the spliced entries
+    return size
+
+
+def _copy_entries(archive, raw):
+    """
+    Append the entries of the zip 'raw' to 'archive' with the public API of zipfile, see _splice_entries
+    """
+    size = 0
+    with zipfile.ZipFile(raw) as source:
+        for info in source.infolist():
+            entry = zipfile.ZipInfo(info.filename, info.date_time)
+            entry.external_attr = info.external_attr
+            entry.compress_type = info.compress_type
+            if info.is_dir():
+                archive.writestr(entry, b'')
+            else:
+                with source.open(info) as data, archive.open(entry, 'w') as out:
+                    shutil.copyfileobj(data, out, COPY_CHUNK_SIZE)
+            size += archive.filelist[-1].compress_size
+    return size
+
+
+def _archive_file(webdav_task_dir, archive_path, project_name):
+    """
+    Path to the archive of the project
+    """
+    return os.path.join(webdav_task_dir, archive_path, project_name) + '.zip'
+
+
+def _manifest_file(webdav_task_dir, archive_path, project_name):
+    """
+    Path to the manifest recording the inputs the archive of the project was built from
+    """
+    return os.path.join(webdav_task_dir, archive_path, '.' + project_name + '.manifest.json')
+
+
+def _stat_files(directory, files):
+    """
+    Map each of the 'files' of 'directory' to its size and modification time
+    """
+    stats = {}
+    for file in files:
+        stat = os.stat(os.path.join(directory, file))
+        stats[file] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+
+def _gen_manifest(config, stats, plugin_path):
+    """
+    Describe everything the archive depends on: the configuration, the stats of
+    the pom.xml template and the 'stats' of every resource, test and library file, by kind (see _stat_files)
+    """
+    manifest = {'version': MANIFEST_VERSION, 'config': config}
+    manifest['pom'] = _stat_files(plugin_path, ['pom.xml'])
+    manifest.update(stats)
+    return manifest
+
+
+def _read_manifest(manifest_file):
+    """
+    Read the manifest stored next to an archive, None if there is none or if it is unreadable
+    """
+    try:
+        with open(manifest_file, encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(manifest_file, manifest):
+    """
+    Store the manifest next to the archive it describes
+    """
+    writing = _temporary_file(manifest_file)
+    with open(writing, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, sort_keys=True)
+    os.replace(writing, manifest_file)
+
+
+def _temporary_file(path):
+    """
+    Hidden path, unique to the current thread, where 'path' can be written before being renamed to 'path'
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{}.{}-{}.tmp'.format(name, os.getpid(), threading.get_ident()))
+
+
+def _publish_archive(building, archive, manifest_file, manifest):
+    """
+    Replace the archive by the complete 'building' one with an atomic rename, so that readers always
+    get either the previous archive or the new one, never a partial one. Then store its manifest.
+    """
+    if os.path.isfile(manifest_file):
+        os.remove(manifest_file)  # without manifest, the archive is rebuilt if we are stopped before the end
+    os.replace(building, archive)
+    _write_manifest(manifest_file, manifest)
+
+
+def _file_fact(function, path, stat):
+    """
+    Get 'function(path)', a fact about the content of the file 'path' whose size and modification time are
+    'stat' (see _stat_files). The fact is computed again only if the file changes.
+    """
+    key = (function.__name__, os.path.abspath(path))
+    with _FILE_FACTS_LOCK:
+        cached = _FILE_FACTS.get(key)
+    if cached is not None and cached[0] == stat:
+        return cached[1]
+    fact = function(path)
+    with _FILE_FACTS_LOCK:
+        if len(_FILE_FACTS) >= FILE_FACTS_MAX_SIZE:
+            _FILE_FACTS.clear()
+        _FILE_FACTS[key] = (list(stat), fact)
+    return fact
+
+
+def _hash_file(path, stat):
+    """
+    Hash of the content of the file 'path', whose size and modification time are 'stat'
+    """
+    return _file_fact(_content_hash, path, stat)
+
+
+def _content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _store_key(inputs, manifest):
+    """
+    Key of the sources of a project (see _gen_sources) in the store: the hash of everything they depend on, that is
+    the compression of the sources and the name and content of every resource and test file ('inputs' and 'manifest'
+    of _build). The projects of different tasks or courses with identical sources, or of the same task before and
+    after a change that was reverted, have the same key. The libraries are not part of it: they come from the bundle
+    of the course (see _get_libs_bundle).
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([MANIFEST_VERSION, manifest['config']['compression']['sources']]).encode('utf-8'))
+    for kind in ('resources', 'tests'):
+        directory, files = inputs[kind]
+        for file in files:
+            content = _hash_file(os.path.join(directory, file), manifest[kind][file])
+            digest.update(json.dumps([kind, file, content]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _store_blob(key, create=True):
+    """
+    Path to the sources of a project with the key 'key' (see _store_key) in the store.
+    The directories of the store are checked like the one of the bundles of the libraries (see _private_directory),
+    and created if 'create' is True.
+    :raise FileNotFoundError: If 'create' is False and the directories do not exist
+    :raise PermissionError: If the directories are not private
+    """
+    _private_directory(ARCHIVE_STORE_PATH, 'the store of the archives', create)
+    directory = _private_directory(os.path.join(ARCHIVE_STORE_PATH, key[:2]), 'the store of the archives', create)
+    return os.path.join(directory, key + '.zip')
+
+
+def _open_from_store(key):
+    """
+    Open the sources of a project with the key 'key' in the store, and mark them as used (see collect_store)
+    :return: The open sources, None if the store does not have them
+    """
+    try:
+        sources = open(_store_blob(key, False), 'rb')  # still readable if they are collected in the meantime
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(sources.fileno())
+    except OSError:
+        pass  # a read-only store is still used, but its sources may be collected
+    return sources
+
+
+def _add_to_store(key, write):
     """
-    Create the archive from the generated project
+    Write the sources of a project with 'write(archive)' and add them to the store under the key 'key'.
+    A failure only loses the sharing of the sources, it is logged and ignored.
+    :return: The open sources (see _open_from_store), None if they could not be added to the store
     """
-    shutil.make_archive(os.path.join(webdav_task_dir, archive_path, project_name), 'zip', new_dir)
-    shutil.rmtree(new_dir)
+    blob = _store_blob(key)
+    adding = _temporary_file(blob)
+    try:
+        with _open_archive(adding) as archive:
+            write(archive)
+        os.replace(adding, blob)
+    except BaseException as e:
+        if os.path.isfile(adding):
+            os.remove(adding)
+        if not isinstance(e, OSError):
+            raise
+        logger.warning('Cannot add %s to the store of the archives', blob, exc_info=True)
+        return None
+    return _open_from_store(key)
 
 
-def _delete_archive(webdav_task_dir, archive_path, project_name):
+def collect_store(store_path=None, max_age=STORE_MAX_AGE):
     """
-    Delete the archive if one exist with the same name (remove an old one)
+    Remove the sources of the store that were not used for 'max_age' seconds, and the files left by the additions
+    to the store that were interrupted. Sources that are removed are only built again the next time they are needed.
+    :param store_path: The directory of the store, ARCHIVE_STORE_PATH if not given
+    :return: A tuple (number of files removed, number of bytes freed)
     """
-    archive = os.path.join(webdav_task_dir, archive_path, project_name) + '.zip'
-    if os.path.isfile(archive):
-        os.remove(archive)
+    store_path = store_path or ARCHIVE_STORE_PATH
+    removed, freed = 0, 0
+    if store_path is None or not os.path.isdir(store_path):
+        return removed, freed
+    limit = time.time() - max_age
+    for prefix in os.listdir(store_path):
+        directory = os.path.join(store_path, prefix)
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime < limit:
+                    os.remove(path)
+                    removed += 1
+                    freed += stat.st_size
+            except FileNotFoundError:
+                pass  # removed by a concurrent collection
+    return removed, freed
 
 
 def check_requirements(webdav_path, task_dir, resource_path, test_path, libs_path, archive_path):
@@ -245,7 +1264,185 @@ def check_requirements(webdav_path, task_dir, resource_path, test_path, libs_pat
     return req
 
 
-def run(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path, requirement, plugin_path):
+def get_task_facts(webdav_path, task_dir, resource_path, test_path, libs_path, archive_path, ttl=TASK_FACTS_TTL,
+                   selection=None):
+    """
+    Get the requirements of the task (see check_requirements) and whether its resource directory has classes to put
+    in the project, for the pages displayed at each view of a task.
+    The task is looked up in the index of the course (see get_course_index), refreshed if it is older than 'ttl'
+    seconds, so that repeated views of a task do not touch the filesystem.
+    :param selection: The selection of the files of the projects (see run)
+    :return: A tuple (requirements, has classes); the requirements must not be modified
+    """
+    entry = get_course_index(webdav_path, libs_path, resource_path, test_path, archive_path,
+                             selection).get_task(task_dir, ttl)
+    return entry['requirement'], entry['classes']
+
+
+def get_course_index(webdav_path, libs_path, resources_path, test_path, archive_path, selection=None):
+    """
+    Get the index of the course shared by the callers using the same configuration, see CourseIndex
+    """
+    paths = (webdav_path, libs_path, resources_path, test_path, archive_path)
+    key = paths + (json.dumps(_get_selection(selection), sort_keys=True),)
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(key)
+        if index is None:
+            if len(_INDEXES) >= INDEXES_MAX_SIZE:
+                _INDEXES.clear()
+            index = _INDEXES[key] = CourseIndex(*paths, selection=selection)
+        return index
+
+
+class CourseIndex:
+    """
+    Index of the inputs of the tasks of a course: for each task directory, its requirements (see check_requirements),
+    whether it has classes and the size and modification time of its classes and tests, as well as those of
+    the libraries of the course, as selected by 'selection' (see run). The index is built with a single walk of the
+    course directory and refreshed incrementally: a directory is listed again only if its modification time changed,
+    the files of the other ones are only stat'ed again.
+    """
+
+    def __init__(self, webdav_path, libs_path, resources_path, test_path, archive_path, selection=None):
+        self.webdav_path = webdav_path
+        self.libs_path = libs_path
+        self.resources_path = resources_path
+        self.test_path = test_path
+        self.archive_path = archive_path
+        self.selection = _get_selection(selection)
+        self._lock = threading.RLock()
+        self._libs = None  # (modification time, {name: [size, modification time]}) of the libraries directory
+        self._tasks = {}  # task -> entry (see _index_task)
+
+    def refresh(self):
+        """
+        Update the index of all the tasks of the course
+        :return: A tuple (tasks whose inputs changed, True if the libraries changed)
+        """
+        with self._lock:
+            libs_changed = self._refresh_libs()
+            tasks = {}
+            try:
+                with os.scandir(self.webdav_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            tasks[entry.name] = self._index_task(entry.name, self._tasks.get(entry.name), True)
+            except OSError:
+                pass  # the webdav does not exist, there is no task
+            changed = [task for task, entry in tasks.items()
+                       if task not in self._tasks or entry['files'] != self._tasks[task]['files']]
+            self._tasks = tasks
+            return sorted(changed), libs_changed
+
+    def get_task(self, task_dir, max_age=None):
+        """
+        Get the entry of a task, a dictionary with the following keys:
+            requirement: the requirements of the task (see check_requirements)
+            classes: True if its resource directory has classes to put in the project
+            files: the size and modification time of its files by kind ('resources', 'tests') and name
+        :param max_age: If set, refresh the entry (and the libraries) if it is older than 'max_age' seconds,
+                        otherwise the entry is refreshed only if the task is not in the index yet
+        """
+        with self._lock:
+            entry = self._tasks.get(task_dir)
+            if entry is None or (max_age is not None and entry['refreshed'] + max_age <= time.monotonic()):
+                self._refresh_libs()
+                entry = self._tasks[task_dir] = self._index_task(task_dir, entry, False)
+            return entry
+
+    def get_libs(self):
+        """
+        Get the size and modification time of the libraries by name, None if the libraries directory does not exist
+        """
+        with self._lock:
+            return None if self._libs is None else self._libs[1]
+
+    def get_tasks(self):
+        """
+        Get the names of the task directories of the course
+        """
+        with self._lock:
+            return sorted(self._tasks)
+
+    def _refresh_libs(self):
+        libs = _index_directory(os.path.join(self.webdav_path, self.libs_path), self._libs,
+                                self.selection['libraries'])
+        changed = (libs is None) != (self._libs is None) or (libs is not None and libs[1] != self._libs[1])
+        self._libs = libs
+        return changed
+
+    def _index_task(self, task_dir, previous, exists):
+        """
+        Index the task 'task_dir' from its 'previous' entry, 'exists' is set if the task directory is known to exist
+        """
+        task_path = os.path.join(self.webdav_path, task_dir)
+        resources = _index_directory(os.path.join(task_path, self.resources_path),
+                                     previous and previous['dirs']['resources'],
+                                     _without_archive(self.selection['resources'], task_dir))
+        tests = _index_directory(os.path.join(task_path, self.test_path), previous and previous['dirs']['tests'],
+                                 _without_archive(self.selection['tests'], task_dir))
+        req = {
+            'webdav': True,
+            'task_path': True,
+            'resource_path': resources is not None,
+            'test_path': tests is not None,
+            'libs_path': self._libs is not None,
+            'archive_path': True
+        }
+        if resources is None and not exists:
+            # the resource directory does not tell anything about its parents
+            req['task_path'] = os.path.isdir(task_path)
+            req['webdav'] = req['task_path'] or os.path.isdir(self.webdav_path)
+        if os.path.normpath(self.archive_path) == os.path.normpath(self.resources_path):
+            req['archive_path'] = req['resource_path']
+        else:
+            req['archive_path'] = os.path.isdir(os.path.join(task_path, self.archive_path))
+        return {
+            'requirement': req,
+            'classes': bool(resources and resources[1]),
+            'files': {'resources': resources and resources[1], 'tests': tests and tests[1]},
+            'dirs': {'resources': resources, 'tests': tests},
+            'refreshed': time.monotonic()
+        }
+
+
+def _without_archive(patterns, task_dir):
+    """
+    Add to 'patterns' (see _is_selected) the exclusion of the archives of the task 'task_dir', which may be
+    generated in the directory the patterns apply to
+    """
+    return [patterns[0], patterns[1] + ['*_' + glob.escape(task_dir) + '.zip']]
+
+
+def _index_directory(directory, previous, patterns):
+    """
+    Get the modification time of 'directory' and the size and modification time of its files that are put inside
+    the projects (see _list_files), None if it does not exist. If the directory did not change since the 'previous'
+    result, the files are not listed again, only stat'ed.
+    """
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+    if previous is not None and previous[0] == mtime:
+        try:
+            return mtime, _stat_files(directory, previous[1])
+        except OSError:
+            pass  # a file disappeared, the directory must be listed again
+    files = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and _is_selected(entry.name, patterns):
+                    stat = entry.stat()
+                    files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        return None  # not a directory
+    return mtime, files
+
+
+def run(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path, requirement, plugin_path,
+        force=False, listener=None, index=None, compression=None, selection=None):
     """
     Create an IntelliJ project for the specified task
     :param webdav_path: A path to the webdav
@@ -256,18 +1453,316 @@ def run(webdav_path, task_dir, course_id, libs_path, resources_path, test_path,
                             containing the java classes to be filled by students
     :param test_path: The path inside the task directory to the directory containing the tests
     :param archive_path: The path inside the task directory to the directory where the archive will be generated
+    :param force: Rebuild the archive even if its manifest shows that none of its inputs changed
+    :param listener: A function called with the task, the name and the metrics of each stage of the generation
+                     (see _stage)
+    :param index: The index of the course (see CourseIndex) giving the files of the task, as of its last refresh.
+                  The files are listed again if not given.
+    :param compression: The compression of each kind of entry, by kind: 'sources' for the java files and the
+                        pom.xml and 'libs' for the jars (see parse_compression). The kinds that are not given get
+                        their compression of DEFAULT_COMPRESSION.
+    :param selection: The files put in the project (see DEFAULT_SELECTION for the settings and their default
+                      values). If 'index' is given, its selection is used instead.
+    :return: True if the archive was (re)built, False if the existing one was up to date
+    Concurrent calls for the same archive are coalesced: the first one builds it,
+    the other ones wait for it and return its result. If the listener of the first one stops it by raising
+    BuildCancelled, the other ones build the archive instead.
+    If ARCHIVE_STORE_PATH is set, the compressed sources of the project are taken from the store, where they are
+    shared by all the projects with the same sources (see _store_key) and compressed only if the store does not have
+    them yet. Each archive still holds a full copy of them: the store saves compressing them, not disk space.
     """
+    archive = os.path.abspath(_archive_file(os.path.join(webdav_path, task_dir), archive_path,
+                                            course_id + '_' + task_dir))
+    while True:
+        with _BUILDS_LOCK:
+            build = _BUILDS.get(archive)
+            leader = build is None
+            if leader:
+                build = _BUILDS[archive] = Future()
+                build.set_running_or_notify_cancel()
+        if leader:
+            break
+        try:
+            return build.result()  # raises the error of the build if it failed
+        except BuildCancelled:
+            pass  # only its caller gave up the build: take it over
+    try:
+        built = _build(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path,
+                       requirement, plugin_path, force, listener, index, compression, selection)
+    except BaseException as e:
+        _end_build(archive)
+        build.set_exception(e)
+        raise
+    _end_build(archive)
+    build.set_result(built)
+    return built
+
+
+def _end_build(archive):
+    """
+    Forget the build of 'archive' of run, before its result is given to the calls waiting for it,
+    so that they can build it again if it was cancelled
+    """
+    with _BUILDS_LOCK:
+        del _BUILDS[archive]
+
+
+def _build(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path, requirement,
+           plugin_path, force, listener, index, compression, selection):
+    """
+    Create the archive of the IntelliJ project of the specified task, see run
+    """
+    methods = _get_compression(compression)
     project_name = course_id + '_' + task_dir  # define project name
     webdav_task_dir = os.path.join(webdav_path, task_dir)  # path to task
-    _delete_archive(webdav_task_dir, archive_path, project_name)  # delete the project archive if one exists
-    new_dir = _create_structure(webdav_task_dir, project_name)  # create the project directory and get the path to it
-    src = gen_src(new_dir)  # create the src folder
-    _gen_classes(webdav_task_dir, src, resources_path)  # add the classes to be filled by students
-    _gen_tests(webdav_task_dir, src, test_path, requirement['test_path'])  # add tests if there are tests
-    libs = _gen_libs(webdav_path, new_dir, libs_path, requirement['libs_path'])  # add libraries if there are libs
-    _gen_target(new_dir)  # create target directory with sub directories
-    _gen_pom(new_dir, project_name, libs, requirement['libs_path'], plugin_path)  # generate pom.xml file
-    _gen_archive(new_dir, webdav_task_dir, archive_path, project_name)  # generate the archive
+    with _stage(task_dir, 'scan', listener) as metrics:
+        inputs, manifest = _scan_inputs(webdav_path, task_dir, course_id, libs_path, resources_path, test_path,
+                                        archive_path, requirement, plugin_path, index, methods, selection)
+        metrics['files'] = sum(len(files) for _, files in inputs.values())
+        metrics['bytes'] = sum(stat[0] for kind in inputs for stat in manifest[kind].values())
+    manifest_file = _manifest_file(webdav_task_dir, archive_path, project_name)
+    archive_file = _archive_file(webdav_task_dir, archive_path, project_name)
+    with _stage(task_dir, 'manifest', listener) as metrics:
+        metrics['cache_hit'] = not force and os.path.isfile(archive_file) \
+            and _read_manifest(manifest_file) == manifest
+    if metrics['cache_hit']:
+        return False  # nothing changed since the last generation
+    sources = None  # the entries of the classes and of the tests, from the store
+    if ARCHIVE_STORE_PATH is not None:
+        with _stage(task_dir, 'store', listener) as metrics:
+            # the same sources may already have been put in a project, of this task or of another one
+            store_key = _store_key(inputs, manifest)
+            metrics['files'] = sum(len(inputs[kind][1]) for kind in ('resources', 'tests'))
+            metrics['bytes'] = sum(stat[0] for kind in ('resources', 'tests') for stat in manifest[kind].values())
+            sources = None if force else _open_from_store(store_key)
+            metrics['cache_hit'] = sources is not None
+        if sources is None:
+            sources = _add_to_store(store_key, lambda archive: _gen_sources(archive, task_dir, inputs, methods,
+                                                                            listener))
+    building = _temporary_file(archive_file)
+    try:
+        # stream every entry of the project directly into a new archive
+        with _open_archive(building) as archive:
+            if sources is None:
+                _gen_sources(archive, task_dir, inputs, methods, listener)
+            else:
+                with sources, _stage(task_dir, 'sources', listener) as metrics:
+                    # the entries of the store are copied as they are, without compressing them again
+                    first = len(archive.filelist)
+                    _splice_entries(archive, sources)
+                    metrics['bytes'], metrics['compressed'] = _entries_size(archive, first)
+                    metrics['files'] = sum(1 for info in archive.filelist[first:] if not info.is_dir())
+            _gen_libraries(archive, task_dir, inputs, manifest, methods, listener)
+            _gen_target(archive)  # create target directory with sub directories
+            with _stage(task_dir, 'pom', listener) as metrics:
+                # generate pom.xml file
+                first = len(archive.filelist)
+                _gen_pom(archive, project_name, _parse_dependencies(inputs['libs'][1]), requirement['libs_path'],
+                         plugin_path, methods['sources'])
+                metrics['bytes'], metrics['compressed'] = _entries_size(archive, first)
+                metrics['files'] = 1
+        with _stage(task_dir, 'publish', listener) as metrics:
+            metrics['bytes'] = os.path.getsize(building)
+            _publish_archive(building, archive_file, manifest_file, manifest)
+    except BaseException:
+        if os.path.isfile(building):
+            os.remove(building)  # never leave a partial archive behind
+        raise
+    return True
+
+
+def _gen_sources(archive, task_dir, inputs, methods, listener):
+    """
+    Add the classes and the tests of the files 'inputs' (see _scan_inputs) to the 'src' directory of the project,
+    whose content does not depend on the name of the project, see _build
+    """
+    _add_directory(archive, 'src')  # create the src folder
+    with _stage(task_dir, 'classes', listener) as metrics:
+        # add the classes to be filled by students
+        first = len(archive.filelist)
+        _gen_classes(archive, *inputs['resources'], methods['sources'])
+        metrics['bytes'], metrics['compressed'] = _entries_size(archive, first)
+        metrics['files'] = len(inputs['resources'][1])
+    with _stage(task_dir, 'tests', listener) as metrics:
+        first = len(archive.filelist)
+        _gen_tests(archive, *inputs['tests'], methods['sources'])  # add tests if there are tests
+        metrics['bytes'], metrics['compressed'] = _entries_size(archive, first)
+        metrics['files'] = len(inputs['tests'][1])
+
+
+def _gen_libraries(archive, task_dir, inputs, manifest, methods, listener):
+    """
+    Add the libraries of the files 'inputs' (see _scan_inputs) to the project from the bundle of the course, see _build
+    """
+    with contextlib.ExitStack() as stack:
+        bundle = None
+        if inputs['libs'][1]:
+            with _stage(task_dir, 'libs_bundle', listener) as metrics:
+                # shared by the tasks of the course
+                bundle, built = _get_libs_bundle(inputs['libs'][0], manifest['libs'], methods['libs'])
+                stack.enter_context(bundle)
+                metrics['cache_hit'] = not built
+                metrics['files'] = len(inputs['libs'][1])
+        with _stage(task_dir, 'libs', listener) as metrics:
+            first = len(archive.filelist)
+            _gen_libs(archive, bundle)  # add libraries if there are libs
+            metrics['bytes'], metrics['compressed'] = _entries_size(archive, first)
+            metrics['files'] = len(inputs['libs'][1])
+
+
+def _scan_inputs(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path, requirement,
+                 plugin_path, index, methods, selection):
+    """
+    List the files put in the project of the task and describe them, see run
+    :param methods: The compression of each kind of entry (see _get_compression)
+    :return: A tuple (directory and sorted names of the files of each kind of input, manifest of the archive)
+    """
+    selection = index.selection if index is not None else _get_selection(selection)
+    webdav_task_dir = os.path.join(webdav_path, task_dir)  # path to task
+    public = os.path.join(webdav_task_dir, resources_path)
+    unit_test = os.path.join(webdav_task_dir, test_path)
+    libraries = os.path.join(webdav_path, libs_path)
+    if index is not None:
+        files = index.get_task(task_dir)['files']
+        stats = {
+            'resources': files['resources'] or {},  # classes to be filled by students
+            'tests': (files['tests'] or {}) if requirement['test_path'] else {},
+            'libs': (index.get_libs() or {}) if requirement['libs_path'] else {}
+        }
+    else:
+        resources = _without_archive(selection['resources'], task_dir)
+        tests = _without_archive(selection['tests'], task_dir)
+        stats = {
+            # classes to be filled by students
+            'resources': _stat_files(public, _list_files(public, resources)),
+            'tests': _stat_files(unit_test, _list_files(unit_test, tests)) if requirement['test_path'] else {},
+            'libs': _stat_files(libraries, _list_files(libraries, selection['libraries']))
+            if requirement['libs_path'] else {}
+        }
+    sources = [(os.path.join(directory, file), stat) for kind, directory in (('resources', public),
+                                                                              ('tests', unit_test))
+               for file, stat in stats[kind].items() if file.endswith('.java')]
+    stats['libs'] = _select_libraries(libraries, stats['libs'], sources, selection)
+    inputs = {
+        'resources': (public, sorted(stats['resources'])),
+        'tests': (unit_test, sorted(stats['tests'])),
+        'libs': (libraries, sorted(stats['libs']))
+    }
+    config = {'course_id': course_id, 'libs_path': libs_path, 'resources_path': resources_path,
+              'test_path': test_path, 'archive_path': archive_path,
+              'compression': {kind: list(method) for kind, method in methods.items()}, 'selection': selection}
+    return inputs, _gen_manifest(config, stats, plugin_path)
+
+
+@contextlib.contextmanager
+def _stage(task_dir, name, listener):
+    """
+    Measure the stage 'name' of the generation of the task 'task_dir'. The body of the 'with' statement
+    fills the metrics it gets with the number of files and bytes it handled, the compressed size of the entries
+    it added to the archive ('compressed') and whether it used a cache ('cache_hit'). The metrics are then logged
+    and given to 'listener(task_dir, name, metrics)'.
+    """
+    metrics = {'duration': 0.0, 'files': 0, 'bytes': 0}
+    start = time.perf_counter()
+    yield metrics
+    metrics['duration'] = time.perf_counter() - start
+    logger.debug('[%s] %s: %.4fs, %d files, %d bytes%s', task_dir, name, metrics['duration'], metrics['files'],
+                 metrics['bytes'], '' if 'cache_hit' not in metrics else ', cache hit' if metrics['cache_hit']
+                 else ', cache miss')
+    if listener is not None:
+        listener(task_dir, name, metrics)
+
+
+class CourseWatcher(threading.Thread):
+    """
+    Watch the tasks and the libraries of a course by polling them (see CourseIndex.refresh), and rebuild in the
+    background the archives whose inputs changed. Changes are debounced: an archive is rebuilt once its inputs did not
+    change for 'debounce' seconds. A change of the libraries rebuilds the archives of all tasks.
+    The arguments are those of run_all, 'progress' is called with the report of each rebuilt archive.
+    'rebuild', if given, is called with the tasks whose archives must be rebuilt (None for all tasks of the course)
+    instead of rebuilding them in the thread of the watcher, for instance to share a limited pool of workers between
+    several courses. It returns the tasks that could not be rebuilt yet, which are retried after 'debounce' seconds.
+    """
+
+    def __init__(self, webdav_path, course_id, libs_path, resources_path, test_path, archive_path, plugin_path,
+                 interval=10.0, debounce=5.0, workers=1, progress=None, compression=None, selection=None,
+                 rebuild=None):
+        super().__init__(name='project_generator_watcher_' + course_id, daemon=True)
+        self.webdav_path = webdav_path
+        self.course_id = course_id
+        self.libs_path = libs_path
+        self.resources_path = resources_path
+        self.test_path = test_path
+        self.archive_path = archive_path
+        self.plugin_path = plugin_path
+        self.interval = interval
+        self.debounce = debounce
+        self.workers = workers
+        self.progress = progress
+        self.compression = compression
+        self.rebuild = rebuild
+        self._stopped = threading.Event()
+        self._index = CourseIndex(webdav_path, libs_path, resources_path, test_path, archive_path, selection)
+        self._pending = {}  # task -> time of its last change
+
+    def run(self):
+        # archives that became stale while nobody was watching are rebuilt first
+        if self.rebuild is not None:
+            self._index.refresh()  # the changes are looked for from now on
+            self.rebuild(None)
+        else:
+            self._report(run_all(self.webdav_path, self.course_id, self.libs_path, self.resources_path, self.test_path,
+                                 self.archive_path, self.plugin_path, workers=self.workers, index=self._index,
+                                 compression=self.compression))
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('[%s] Cannot watch the course', self.course_id)
+
+    def stop(self):
+        """ Stop watching, after the current poll """
+        self._stopped.set()
+
+    def poll(self):
+        """
+        Look for changes since the previous poll, and rebuild the archives whose changes are old enough
+        :return: The reports of the rebuilt archives, empty if they are rebuilt by 'rebuild'
+        """
+        now = time.monotonic()
+        changed, libs_changed = self._index.refresh()
+        if libs_changed:
+            changed = self._index.get_tasks()  # the libraries are in all archives
+        for task in changed:
+            self._pending[task] = now
+        ready = sorted(task for task, changed_at in self._pending.items() if changed_at + self.debounce <= now)
+        for task in ready:
+            del self._pending[task]
+        entries = {task: self._index.get_task(task) for task in ready}
+        ready = [task for task in ready
+                 if process_requirements(entries[task]['requirement']) and entries[task]['classes']]
+        if self.rebuild is not None:
+            for task in self.rebuild(ready) if ready else []:
+                self._pending.setdefault(task, now)
+            return []
+        reports = []
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            futures = []
+            for task in ready:
+                futures.append(pool.submit(run_with_report, self.webdav_path, task, self.course_id,
+                                           self.libs_path, self.resources_path, self.test_path,
+                                           self.archive_path, entries[task]['requirement'], self.plugin_path,
+                                           index=self._index, compression=self.compression))
+            reports = [future.result() for future in futures]
+        self._report(reports)
+        return reports
+
+    def _report(self, reports):
+        for report in reports:
+            logger.info('[%s/%s] %s in %.3fs%s', self.course_id, report['task'], report['status'],
+                        report['duration'], '' if report['error'] is None else ': ' + report['error'])
+            if self.progress is not None:
+                self.progress(report)
 
 
 def process_requirements(requirement):
@@ -297,6 +1792,10 @@ def process_args():
     group.add_argument('-task', '--task_dir', help='The directory name inside the webdav')
     group.add_argument('-A', '--all', help='Generate an IntelliJ project for all tasks inside the webdav',
                         default=False, action='store_true')
+    group.add_argument('-B', '--batch', help='Generate an IntelliJ project for all tasks of several courses: each '
+                                             'path is a course directory or an INGInious tasks directory, the '
+                                             'settings of a course are read from its course.yaml',
+                       nargs='+', metavar='PATH')
     parser.add_argument('-wd', '--webdav_path', help='The location of the webdav of the course', default=webdav_path)
     parser.add_argument('-c', '--course_id', help='The course acronym', default=course_id)
     parser.add_argument('-l', '--libraries_path', help='The path inside the webdav to the libraries to include '
@@ -308,6 +1807,45 @@ def process_args():
     parser.add_argument('-arch', '--archive_path', help='The path inside path_dir to the directory where the archive '
                                                      'of the project will be generated', default=archive_path)
     parser.add_argument('-p', '--plugin_path', help='Path to the location of this script', default=generator_path)
+    parser.add_argument('-j', '--workers', help='The number of archives built concurrently with -A or -B',
+                        default=1, type=int)
+    parser.add_argument('-v', '--verbose', help='Print the metrics of each stage of the generation',
+                        default=False, action='store_true')
+    parser.add_argument('-w', '--watch', help='With -A, keep watching the webdav and rebuild the archives whose '
+                                              'inputs changed', default=False, action='store_true')
+    parser.add_argument('--interval', help='The time between two polls of the webdav with -w, in seconds',
+                        default=10.0, type=float)
+    parser.add_argument('--debounce', help='The time without changes before an archive is rebuilt with -w, '
+                                           'in seconds', default=5.0, type=float)
+    parser.add_argument('-f', '--force', help='Rebuild the archives even if their inputs did not change',
+                        default=False, action='store_true')
+    parser.add_argument('--json', help='With -B, print a JSON summary of the generation instead of the reports',
+                        default=False, action='store_true')
+    parser.add_argument('--sources_compression', help='The compression of the java files and of the pom.xml: '
+                                                      'stored, deflated, bzip2 or lzma, optionally followed by a '
+                                                      'level like deflated:9', default=DEFAULT_COMPRESSION['sources'])
+    parser.add_argument('--libs_compression', help='The compression of the libraries, like --sources_compression',
+                        default=DEFAULT_COMPRESSION['libs'])
+    parser.add_argument('-s', '--select', help='A setting of the selection of the files put inside the projects, like '
+                                               'libraries_include=*.jar,*.zip or libraries_max_size=10000000, '
+                                               'can be repeated', action='append', default=[], metavar='SETTING=VALUE')
+    parser.add_argument('--store', help='The directory of a store shared by the archives, only writable by the user '
+                                        'running the generator: the sources of the projects with the same classes '
+                                        'and tests, in any task or course, are compressed once', default=None)
+    parser.add_argument('--gc', help='With --store, remove the content of the store that was not used for --gc_days '
+                                     'days after the generation', default=False, action='store_true')
+    parser.add_argument('--gc_days', help='The number of days after which an unused content of the store is removed '
+                                          'with --gc', default=STORE_MAX_AGE / (24 * 3600), type=float)
+    parser.add_argument('--libs_cache', help='The directory where the libraries compressed for the projects are kept, '
+                                             'only writable by the user running the generator (a temporary '
+                                             'directory removed at the end by default)', default=None)
+    parser.add_argument('--verify', help='Verify the archives instead of generating them: rebuild those that are '
+                                         'missing, incomplete or not matching the current files and settings',
+                        default=False, action='store_true')
+    parser.add_argument('--deep', help='With --verify, also check the CRC of every entry of the archives',
+                        default=False, action='store_true')
+    parser.add_argument('--check_only', help='With --verify, only report the archives that are not valid, without '
+                                             'rebuilding them', default=False, action='store_true')
 
     args = parser.parse_args()
     task_dir = args.task_dir
@@ -318,13 +1856,84 @@ def process_args():
     test_path = args.tests_path
     archive_path = args.archive_path
     generator_path = args.plugin_path
-    if args.all:
+    compression = {'sources': args.sources_compression, 'libs': args.libs_compression}
+    selection = dict(setting.partition('=')[::2] for setting in args.select)
+    if args.watch and not args.all:
+        parser.error('-w/--watch requires -A/--all')
+    if args.gc and args.store is None:
+        parser.error('--gc requires --store')
+    if (args.deep or args.check_only) and not args.verify:
+        parser.error('--deep and --check_only require --verify')
+    if args.verify and args.watch:
+        parser.error('--verify and -w/--watch cannot be used together')
+    global ARCHIVE_STORE_PATH, LIBS_BUNDLES_PATH
+    ARCHIVE_STORE_PATH = args.store
+    LIBS_BUNDLES_PATH = args.libs_cache
+    try:
+        _get_compression(compression)
+        _get_selection(selection)
+    except ValueError as e:
+        parser.error(str(e))
+    for setting in selection:
+        if setting not in DEFAULT_SELECTION:
+            parser.error('Unknown selection setting {!r}, expected one of {}'.format(setting,
+                                                                                     ', '.join(DEFAULT_SELECTION)))
+    if args.watch:
+        # build the outdated archives, then rebuild them as soon as their inputs change
+        watcher = CourseWatcher(webdav_path, course_id, libs_path, resources_path, test_path, archive_path,
+                                generator_path, args.interval, args.debounce, args.workers,
+                                lambda report: _print_report([report]), compression, selection)
+        watcher.start()
+        try:
+            while watcher.is_alive():
+                watcher.join(1)
+        except KeyboardInterrupt:
+            watcher.stop()
+    elif args.batch:
+        # the settings given on the command line are used for the courses whose descriptor does not override them
+        courses = find_courses(args.batch, {"libraries_path": libs_path, "resources_path": resources_path,
+                                            "tests_path": test_path, "archive_path": archive_path,
+                                            "sources_compression": compression['sources'],
+                                            "libs_compression": compression['libs'], **selection})
+        progress = None if args.json else lambda course, report: _print_report([dict(report, task=course + '/' +
+                                                                                           report['task'])])
+        summary = run_courses(courses, generator_path, args.force, args.workers, progress, verify=args.verify,
+                              repair=not args.check_only, deep=args.deep)
+        if args.gc:
+            removed, freed = collect_store(max_age=args.gc_days * 24 * 3600)
+            summary['store'] = {'removed': removed, 'freed': freed}
+        if args.json:
+            print(json.dumps(summary, indent=2))
+        else:
+            for course in summary['courses']:
+                print('[{}] {} tasks in {:.3f}s{}'.format(course['course'], len(course['reports']), course['duration'],
+                                                         '' if course['error'] is None else ': ' + course['error']))
+            if args.verbose:
+                _print_stages([report for course in summary['courses'] for report in course['reports']])
+            if args.gc:
+                print('[store] {removed} unused files removed, {freed} B freed'.format(**summary['store']))
+    elif args.all and args.verify:
+        _print_report(verify_all(webdav_path, course_id, libs_path, resources_path, test_path, archive_path,
+                                 generator_path, not args.check_only, args.deep, args.workers,
+                                 compression=compression, selection=selection), args.verbose)
+    elif args.all:
         # if option all set
-        run_all(webdav_path, course_id, libs_path, resources_path, test_path, archive_path, generator_path)
+        _print_report(run_all(webdav_path, course_id, libs_path, resources_path, test_path, archive_path,
+                              generator_path, args.force, args.workers, compression=compression,
+                              selection=selection), args.verbose)
     else:
         requirement = check_requirements(webdav_path, task_dir, resources_path, test_path, libs_path, archive_path)
-        if process_requirements(requirement):
-            run(webdav_path, task_dir, course_id, libs_path, resources_path, test_path, archive_path, requirement, generator_path)
+        if process_requirements(requirement) and args.verify:
+            _print_report([verify_task(webdav_path, task_dir, course_id, libs_path, resources_path, test_path,
+                                       archive_path, requirement, generator_path, not args.check_only, args.deep,
+                                       compression=compression, selection=selection)], args.verbose)
+        elif process_requirements(requirement):
+            _print_report([run_with_report(webdav_path, task_dir, course_id, libs_path, resources_path, test_path,
+                                           archive_path, requirement, generator_path, args.force,
+                                           compression=compression, selection=selection)], args.verbose)
+    if args.gc and not args.batch:
+        removed, freed = collect_store(max_age=args.gc_days * 24 * 3600)
+        print('[store] {} unused files removed, {} B freed'.format(removed, freed))
 
 
 if __name__ == '__main__':
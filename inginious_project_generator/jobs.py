@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of INGInious. See the LICENSE and the COPYRIGHTS files for
+# more information about the licensing of this file.
+
+""" Background generation of the archives, outside of the web requests """
+
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class GenerationJob:
+    """
+    A generation of the archive of one task, or of all tasks of a course (task_id is None).
+    Its kind is "generation", or "verification" for a verification of the archives.
+    """
+
+    def __init__(self, job_id, course_id, task_id, kind="generation"):
+        self.id = job_id
+        self.course_id = course_id
+        self.task_id = task_id
+        self.kind = kind
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.reports = []
+        self.error = None
+
+    def is_finished(self):
+        return self.status in ("done", "failed")
+
+    def to_dict(self):
+        """ JSON-serializable view of the job """
+        return {
+            "id": self.id,
+            "course_id": self.course_id,
+            "task_id": self.task_id,
+            "kind": self.kind,
+            "status": self.status,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "reports": list(self.reports),
+            "error": self.error
+        }
+
+
+class JobQueue:
+    """
+    Runs the generation jobs on a pool of threads.
+    A job submitted for a (course, task) that is already queued or running is not duplicated:
+    the existing job is returned instead.
+    """
+
+    def __init__(self, workers=2, history=100):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="project_generator")
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._history = history
+        self._jobs = {}  # job id -> job, ordered by submission
+        self._active = {}  # (course id, task id) -> queued or running job
+
+    def submit(self, course_id, task_id, function, *args, kind="generation", **kwargs):
+        """
+        Submit a job calling 'function(*args, **kwargs)'. The function receives a keyword argument
+        'progress' to call with each task report; it returns the list of all reports.
+        The job of another kind already queued or running for the same (course, task) is returned as well,
+        as both rebuild the same archives.
+        """
+        key = (course_id, task_id)
+        with self._lock:
+            job = self._active.get(key)
+            if job is not None:
+                return job
+            job = GenerationJob(next(self._ids), course_id, task_id, kind)
+            self._active[key] = job
+            self._jobs[job.id] = job
+            while len(self._jobs) > self._history:
+                oldest = next(iter(self._jobs.values()))
+                if not oldest.is_finished():
+                    break
+                del self._jobs[oldest.id]
+        self._pool.submit(self._run, key, job, function, args, kwargs)
+        return job
+
+    def _run(self, key, job, function, args, kwargs):
+        job.status = "running"
+        job.started = time.time()
+        try:
+            reports = function(*args, progress=job.reports.append, **kwargs)
+            job.reports = list(reports)
+            job.status = "failed" if any(report["status"] == "failed" for report in reports) else "done"
+        except Exception as e:
+            job.error = "{}: {}".format(type(e).__name__, e)
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                del self._active[key]
+
+    def get(self, job_id):
+        """ Get a job from its id, None if it is unknown """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_course_jobs(self, course_id):
+        """ All known jobs of a course, the most recent first """
+        with self._lock:
+            return [job for job in reversed(list(self._jobs.values())) if job.course_id == course_id]